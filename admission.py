@@ -0,0 +1,245 @@
+"""Limits that make an overloaded server turn work away instead of falling over."""
+import collections
+import heapq
+import itertools
+import logging
+import math
+import os
+import selectors
+import socket
+import threading
+import time
+import metrics
+
+# What a shed client is told to wait before trying again, in seconds
+RETRY_AFTER = 1
+# A connection that waited this long for a thread is shed, its client has most likely given up
+MAX_QUEUE_WAIT = 5
+
+# /game/state polls per second allowed per client, bursts of up to STATE_RATE_BURST; 0 disables the limit
+STATE_RATE_LIMIT = float(os.getenv('STATE_RATE_LIMIT', 10))
+STATE_RATE_BURST = float(os.getenv('STATE_RATE_BURST', 20))
+
+# Peers whose X-Forwarded-For header is believed, the load balancer connects from here
+TRUSTED_PROXIES = ('127.0.0.1', '::1')
+
+
+def retry_after(seconds):
+    # Retry-After only takes whole seconds
+    return str(max(1, math.ceil(seconds)))
+
+
+class RateLimiter:
+    """Token bucket per client key: rate requests a second on average, bursts of up to burst."""
+
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+        # Least recently used first
+        self.buckets = collections.OrderedDict()
+
+    def allow(self, key):
+        """0 when the request may go ahead, otherwise the seconds until it would."""
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self.update(key, tokens, now)
+                return (1 - tokens) / self.rate
+            self.update(key, tokens - 1, now)
+            return 0
+
+    def update(self, key, tokens, now):
+        if key in self.buckets:
+            self.buckets.move_to_end(key)
+            self.buckets[key] = (tokens, now)
+            return
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.max_clients:
+            self.prune(now)
+
+    def prune(self, now):
+        # A bucket that has refilled completely is the same as no bucket, and the
+        # oldest ones refill first. With none of those the newest client goes untracked
+        refill = self.burst / self.rate
+        oldest = next(iter(self.buckets.values()))
+        if now - oldest[1] >= refill:
+            self.buckets.popitem(last=False)
+        else:
+            self.buckets.popitem()
+
+
+class ConnectionPool:
+    """A fixed number of threads serving accepted connections, with a bounded queue in front.
+
+    submit() never blocks: once every thread is busy and queue_depth
+    connections are already waiting it returns False, and the accept loop
+    sheds the connection. A reaper thread sheds connections that waited
+    MAX_QUEUE_WAIT, so they get their 503 even while no thread frees up.
+    """
+
+    def __init__(self, name, handler, shed, threads=128, queue_depth=256):
+        self.name = name
+        self.handler = handler
+        self.shed = shed
+        self.queue_depth = max(queue_depth, 1)
+        # (connection, address, queued_at, handler, shed), oldest first
+        self.pending = collections.deque()
+        self.ready = threading.Condition()
+        self.idle = 0
+        for i in range(threads):
+            threading.Thread(target=self.serve, daemon=True, name=f"{name}-{i}").start()
+        threading.Thread(target=self.reap, daemon=True, name=f"{name}-reaper").start()
+
+    def submit(self, connection, address):
+        return self.enqueue(connection, address, self.handler, self.shed, self.queue_depth)
+
+    def resume(self, connection, address, handler, shed):
+        """Queue a connection admitted earlier and parked since, for handler(connection, address).
+
+        Not held to queue_depth: one move can wake every subscriber of a
+        game at once, and they were all let in already.
+        """
+        self.enqueue(connection, address, handler, shed)
+
+    def busy(self):
+        # No other thread is free, the calling one should not sit on an idle connection
+        return self.idle == 0
+
+    def enqueue(self, connection, address, handler, shed, limit=None):
+        with self.ready:
+            if limit is not None and len(self.pending) >= limit:
+                return False
+            self.pending.append((connection, address, time.monotonic(), handler, shed))
+            self.ready.notify()
+        metrics.queued_connections.inc(self.name)
+        return True
+
+    def serve(self):
+        while True:
+            with self.ready:
+                self.idle += 1
+                while not self.pending:
+                    self.ready.wait()
+                self.idle -= 1
+                connection, address, _, handler, _ = self.pending.popleft()
+            metrics.queued_connections.dec(self.name)
+            try:
+                handler(connection, address)
+            except Exception as e:
+                logging.error(f"Error serving connection from {address}: {e}")
+
+    def reap(self):
+        while True:
+            expired = []
+            with self.ready:
+                oldest_allowed = time.monotonic() - MAX_QUEUE_WAIT
+                # First in, first out, so everything that expired is at the front
+                while self.pending and self.pending[0][2] <= oldest_allowed:
+                    expired.append(self.pending.popleft())
+                wait = self.pending[0][2] - oldest_allowed if self.pending else MAX_QUEUE_WAIT
+            for connection, address, _, _, shed in expired:
+                metrics.queued_connections.dec(self.name)
+                try:
+                    shed(connection, "queue_timeout")
+                except Exception as e:
+                    logging.error(f"Error shedding connection from {address}: {e}")
+            time.sleep(wait)
+
+
+class Waiter(threading.Thread):
+    """One thread holding the connections that are waiting rather than working.
+
+    Idle keep-alive connections, long-polls and event streams can stay open
+    for many seconds or for good, far too long to keep a pool thread each.
+    park() hands a client over; it goes back to the pool through
+    pool.resume(client.connection, client.address, client.resume,
+    client.overloaded) once one of the sockets in client.watching turns
+    readable or client.deadline passes (None for never). Subclasses give
+    clients back early for other reasons through hand_back().
+    """
+
+    def __init__(self, pool):
+        super().__init__(daemon=True, name=f"{pool.name}-waiter")
+        self.pool = pool
+        self.selector = selectors.DefaultSelector()
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.waker.setblocking(False)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        self.lock = threading.Lock()
+        self.arrived = []
+        # Parked clients with the number of their park, and (deadline, number, client) by deadline.
+        # Entries of clients given back or parked again since are skipped when they come up.
+        self.parked = {}
+        self.deadlines = []
+        self.parks = itertools.count()
+
+    def park(self, client):
+        with self.lock:
+            self.arrived.append(client)
+        self.wake()
+
+    def wake(self):
+        try:
+            self.waker.send(b"\0")
+        except OSError:
+            pass  # Buffer full, a wakeup is pending anyway
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select(self.next_timeout()):
+                if key.fileobj is self.wakeup:
+                    try:
+                        while self.wakeup.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self.hand_back(key.data)
+            with self.lock:
+                arrived, self.arrived = self.arrived, []
+            for client in arrived:
+                self.add(client)
+            self.check(time.monotonic())
+
+    def add(self, client):
+        number = next(self.parks)
+        self.parked[client] = number
+        for sock in client.watching:
+            self.selector.register(sock, selectors.EVENT_READ, client)
+        if client.deadline is not None:
+            heapq.heappush(self.deadlines, (client.deadline, number, client))
+        metrics.parked_connections.inc(self.pool.name)
+
+    def remove(self, client):
+        if self.parked.pop(client, None) is None:
+            return False
+        for sock in client.watching:
+            self.selector.unregister(sock)
+        metrics.parked_connections.dec(self.pool.name)
+        if len(self.deadlines) > 2 * len(self.parked) + 64:
+            # Mostly entries of clients that left early, do not let them pile up
+            self.deadlines = [entry for entry in self.deadlines if self.parked.get(entry[2]) == entry[1]]
+            heapq.heapify(self.deadlines)
+        return True
+
+    def hand_back(self, client):
+        if self.remove(client):
+            self.pool.resume(client.connection, client.address, client.resume, client.overloaded)
+
+    def check(self, now):
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, number, client = heapq.heappop(self.deadlines)
+            if self.parked.get(client) == number:
+                self.hand_back(client)
+
+    def next_timeout(self):
+        while self.deadlines and self.parked.get(self.deadlines[0][2]) != self.deadlines[0][1]:
+            heapq.heappop(self.deadlines)
+        if not self.deadlines:
+            return None
+        return max(0.0, self.deadlines[0][0] - time.monotonic())
@@ -0,0 +1,320 @@
+"""Load test: bots play Liar's Deck against a local server and report latency.
+
+    python benchmark.py --rooms 20 --duration 30 --target both --output results.json
+
+The server is started as a subprocess of server_thread_http.py on the
+in-memory storage backend unless --backend says otherwise. Stored games
+are only dropped with --reset, rooms are named per run so a persistent
+backend does not need it. Raw sockets
+are used because the local http.py shadows the standard library package.
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+LB_PORT = 8181
+WORKER_PORT = 56000
+
+
+class Client:
+    """One keep-alive connection, reopened whenever the server closes it."""
+
+    def __init__(self, port, stats):
+        self.port = port
+        self.stats = stats
+        self.sock = None
+        self.buffer = b""
+
+    def connect(self):
+        self.sock = socket.create_connection(("127.0.0.1", self.port), timeout=10)
+        self.buffer = b""
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def request(self, method, path, payload=None):
+        body = json.dumps(payload).encode() if payload is not None else b""
+        head = f"{method} {path} HTTP/1.1\r\nHost: bench\r\nContent-Length: {len(body)}\r\n"
+        if body:
+            head += "Content-Type: application/json\r\n"
+        endpoint = f"{method} {path.split('?')[0]}"
+        started = time.perf_counter()
+        try:
+            if self.sock is None:
+                self.connect()
+            self.sock.sendall(head.encode() + b"\r\n" + body)
+            status, close, data = self.read_response()
+        except (OSError, ValueError) as e:
+            self.close()
+            self.stats.record(endpoint, time.perf_counter() - started, None, type(e).__name__)
+            return None, None
+        self.stats.record(endpoint, time.perf_counter() - started, status)
+        if close:
+            self.close()
+        return status, (json.loads(data) if data else None)
+
+    def read_response(self):
+        while b"\r\n\r\n" not in self.buffer:
+            self.receive()
+        head, self.buffer = self.buffer.split(b"\r\n\r\n", 1)
+        lines = head.decode('latin-1').split("\r\n")
+        status = int(lines[0].split(" ")[1])
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        while len(self.buffer) < length:
+            self.receive()
+        data, self.buffer = self.buffer[:length], self.buffer[length:]
+        return status, headers.get("connection", "").lower() == "close", data
+
+    def receive(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionError("server closed the connection")
+        self.buffer += data
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = Counter()
+        self.errors = Counter()
+        self.moves = Counter()
+
+    def record(self, endpoint, latency, status, error=None):
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            if error is not None:
+                self.errors[error] += 1
+            else:
+                self.statuses[status] += 1
+                if status >= 500:
+                    self.errors[f"HTTP {status}"] += 1
+
+    def move(self, name, ok):
+        with self.lock:
+            self.moves[f"{name}_{'ok' if ok else 'rejected'}"] += 1
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+
+    def at(q):
+        return round(samples[int(q * (len(samples) - 1))] * 1000, 3)
+
+    return {"p50": at(0.50), "p95": at(0.95), "p99": at(0.99), "max": at(1.0),
+            "mean": round(sum(samples) / len(samples) * 1000, 3)}
+
+
+class Bot(threading.Thread):
+    def __init__(self, port, room_id, deadline, args, stats):
+        super().__init__(daemon=True)
+        self.client = Client(port, stats)
+        self.room_id = room_id
+        self.deadline = deadline
+        self.args = args
+        self.stats = stats
+        self.player_id = None
+        self.state = None
+
+    def run(self):
+        try:
+            status, joined = self.client.request("POST", "/game/join", {"room_id": self.room_id})
+            if status != 200:
+                return
+            self.player_id = joined["player_id"]
+            while time.monotonic() < self.deadline:
+                self.step()
+        finally:
+            self.client.close()
+
+    def poll(self):
+        # Same protocol as the browser: ask for changes since the version already held
+        query = f"room_id={self.room_id}&player_id={self.player_id}"
+        if self.state and "version" in self.state:
+            query += f"&since={self.state['version']}"
+        status, data = self.client.request("GET", f"/game/state?{query}")
+        if status == 200 and data is not None:
+            if "changes" in data:
+                if self.state.get("version") == data["since"]:
+                    self.state = {**self.state, **data["changes"], "version": data["version"]}
+                else:
+                    self.state = None
+            else:
+                self.state = data
+
+    def move(self, name, payload):
+        payload.update({"room_id": self.room_id, "player_id": self.player_id})
+        status, data = self.client.request("POST", f"/game/{name}", payload)
+        self.stats.move(name, status == 200 and (data or {}).get("status") != "ERROR")
+
+    def step(self):
+        self.poll()
+        state = self.state or {}
+        if not state.get("game_started") or state.get("game_winner"):
+            # The first seat deals once the table is full, and again after every game
+            seated = len(state.get("assigned_players", [])) if not state.get("game_started") else self.args.bots_per_room
+            if self.player_id == "player1" and seated >= min(self.args.bots_per_room, 4):
+                self.move("start", {})
+            time.sleep(self.args.poll_interval)
+            return
+
+        if state.get("current_turn") != self.player_id or state.get("is_eliminated"):
+            time.sleep(self.args.poll_interval)
+            return
+
+        time.sleep(random.uniform(0, self.args.think_time))
+        hand = state.get("your_hand") or []
+        if state.get("card_pile_count") and (not hand or random.random() < self.args.challenge_rate):
+            self.move("challenge", {})
+        elif hand:
+            self.move("play", {"cards": random.sample(hand, min(len(hand), random.randint(1, 2)))})
+
+
+def wait_for_server(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        client = Client(port, Stats())
+        status, _ = client.request("GET", "/health")
+        client.close()
+        if status == 200:
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def room_stats(port, room_ids):
+    client = Client(port, Stats())
+    totals = Counter()
+    for room_id in room_ids:
+        status, data = client.request("GET", f"/game/stats?room_id={room_id}")
+        if status == 200:
+            totals["moves"] += data["move_lock"]["moves"]
+            totals["lock_waits"] += data["move_lock"]["contended"]
+            for name, count in data.get("storage_calls", {}).items():
+                totals[f"storage_{name}"] += count
+    client.close()
+    return totals
+
+
+def run_phase(target, args):
+    port = LB_PORT if target == "lb" else WORKER_PORT
+    stats = Stats()
+    room_ids = [f"bench-{args.run_id}-{target}-{i}" for i in range(args.rooms)]
+    deadline = time.monotonic() + args.duration
+    bots = [Bot(port, room_id, deadline, args, stats) for room_id in room_ids for _ in range(args.bots_per_room)]
+    started = time.monotonic()
+    for bot in bots:
+        bot.start()
+    for bot in bots:
+        bot.join()
+    elapsed = time.monotonic() - started
+
+    all_latencies = [latency for samples in stats.latencies.values() for latency in samples]
+    totals = room_stats(port, room_ids)
+    moves = totals.get("moves", 0)
+    return {
+        "target": target,
+        "port": port,
+        "elapsed": round(elapsed, 3),
+        "requests": len(all_latencies),
+        "requests_per_sec": round(len(all_latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": percentiles(all_latencies),
+        "endpoints": {
+            endpoint: {"requests": len(samples), "latency_ms": percentiles(samples)}
+            for endpoint, samples in sorted(stats.latencies.items())
+        },
+        "status_counts": {str(status): count for status, count in sorted(stats.statuses.items())},
+        "errors": dict(stats.errors),
+        "error_rate": round(sum(stats.errors.values()) / len(all_latencies), 5) if all_latencies else 0.0,
+        "moves": dict(stats.moves),
+        "server": dict(totals),
+        "storage_calls_per_move": {
+            name[len("storage_"):]: round(count / moves, 3)
+            for name, count in totals.items() if name.startswith("storage_") and moves
+        },
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Liar's Deck load test")
+    parser.add_argument('--target', choices=['worker', 'lb', 'both'], default='both',
+                        help=f"worker: straight to port {WORKER_PORT}, lb: through LBServer on {LB_PORT}")
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--bots-per-room', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=20, help="seconds per target")
+    parser.add_argument('--poll-interval', type=float, default=0.5, help="seconds between polls while waiting")
+    parser.add_argument('--think-time', type=float, default=0.3, help="up to this many seconds before a move")
+    parser.add_argument('--challenge-rate', type=float, default=0.3)
+    parser.add_argument('--mode', choices=['thread', 'async'], default='thread')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--processes', action='store_true')
+    parser.add_argument('--backend', choices=['memory', 'sqlite', 'mongo'], default='memory',
+                        help="GAME_STORAGE_BACKEND for the server")
+    parser.add_argument('--reset', action='store_true',
+                        help="drop every stored game of the backend before the run")
+    parser.add_argument('--no-server', action='store_true', help="benchmark a server that is already running")
+    parser.add_argument('--output', help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+    if args.processes and args.workers > 1 and args.backend == 'memory' and not args.no_server:
+        parser.error("--processes needs --backend sqlite or mongo, worker processes do not share memory")
+    args.run_id = format(int(time.time()), "x")
+    return args
+
+
+def main():
+    args = parse_args()
+    server = None
+    if not args.no_server:
+        env = dict(os.environ, GAME_STORAGE_BACKEND=args.backend)
+        command = [sys.executable, "server_thread_http.py", "--mode", args.mode, "--workers", str(args.workers)]
+        if args.reset:
+            command.append("--reset-database")
+        if args.processes:
+            command.append("--processes")
+        server = subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        targets = ["worker", "lb"] if args.target == "both" else [args.target]
+        for target in targets:
+            if not wait_for_server(LB_PORT if target == "lb" else WORKER_PORT):
+                sys.exit(f"Server on the {target} port did not become healthy")
+        results = {
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "no_server", "run_id")},
+            "runs": [run_phase(target, args) for target in targets],
+        }
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(10)
+
+    for run in results["runs"]:
+        latency = run["latency_ms"]
+        print(f"{run['target']:>6}: {run['requests_per_sec']} req/s, p50 {latency.get('p50')} ms, "
+              f"p95 {latency.get('p95')} ms, p99 {latency.get('p99')} ms, errors {run['error_rate']:.2%}",
+              file=sys.stderr)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,228 @@
+import copy
+import json
 import random
 import string
-from mongo_client import MongoClient
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from storage import create_store, VersionConflict, LOG_TAIL
+from rules import LiarDeckRules, count_cards, expand_cards
+import metrics
 
-mongodb = MongoClient()
+# Seconds between version checks against Mongo. The in-memory state is
+# authoritative inside this process, the check only picks up changes made
+# by another process sharing the same database.
+SYNC_INTERVAL = 1.0
 
+# A move that loses the optimistic concurrency race is replayed on fresh state
+MAX_COMMIT_ATTEMPTS = 3
+
+# States recently sent to clients, kept so /game/state?since= can answer with a diff
+STATE_HISTORY_SIZE = 64
+
+
+class MoveLock:
+    """Lets one move at a time mutate a game and records how long moves queued for it."""
 
-class LiarDeckGame:
     def __init__(self):
-        mongodb.reset_database()
+        # Reentrant so a move can run sync_state, which takes it too
+        self.lock = threading.RLock()
+        self.moves = 0
+        self.contended = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def __enter__(self):
+        waited = 0.0
+        if not self.lock.acquire(blocking=False):
+            started = time.monotonic()
+            self.lock.acquire()
+            waited = time.monotonic() - started
+            self.contended += 1
+        self.moves += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        metrics.move_lock_wait.observe(waited)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.lock.release()
+
+    def stats(self):
+        return {
+            "moves": self.moves,
+            "contended": self.contended,
+            "wait_total": round(self.wait_total, 6),
+            "wait_avg": round(self.wait_total / self.moves, 6) if self.moves else 0.0,
+            "wait_max": round(self.wait_max, 6)
+        }
+
+
+class LiarDeckGame(LiarDeckRules):
+    """The rules of one room, kept in storage and shared by every request for it."""
+
+    def __init__(self, room_id="default"):
+        super().__init__()
+        self.room_id = room_id
+        self.store = create_store(room_id)
+        # Moves are serialized per game, reads never take this lock
+        self.move_lock = MoveLock()
+        # Round trips to storage by operation, reported next to the lock stats
+        self.store_calls = Counter()
+        # Called with the new version after every change, subscribers wait on these
+        self.watchers = []
+        self.version = 0
         self.reload_state_from_db()
 
     def reload_state_from_db(self):
-        self.players = mongodb.get_all_players_data() or {}
-        self.game_started = True if mongodb.get_game_state() else False
-        self.card_pile = mongodb.get_card_pile() or []
-        self.current_turn_index = mongodb.get_current_turn_index() or 0
-        self.player_order = mongodb.get_player_order() or []
-        self.reference_card = mongodb.get_reference_card()
-        self.last_play = mongodb.get_last_play() or {"player_id": None, "cards": []}
-        self.game_winner = mongodb.get_game_winner() or None
-        self.log = mongodb.get_log() or []
-        self.assigned_players = mongodb.get_assigned_players() or []
+        previous_version = self.version
+        self.load_document(self.call_store("load_game") or {})
+        self.last_sync = time.monotonic()
+        if self.version != previous_version:
+            self.notify_change()
+
+    def call_store(self, operation, *args):
+        self.store_calls[operation] += 1
+        with metrics.storage_calls.time(operation):
+            return getattr(self.store, operation)(*args)
+
+    def notify_change(self):
+        for watcher in list(self.watchers):
+            watcher(self.version)
+
+    def load_document(self, doc):
+        self.players = doc.get("players") or {}
+        for player_data in self.players.values():
+            player_data["hand"] = count_cards(player_data.get("hand") or [])
+        self.game_started = True if doc.get("game_started") else False
+        self.card_pile = count_cards(doc.get("card_pile") or [])
+        self.current_turn_index = doc.get("current_turn_index") or 0
+        self.player_order = doc.get("player_order") or []
+        self.reference_card = doc.get("reference_card")
+        self.last_play = doc.get("last_play") or {"player_id": None, "cards": []}
+        self.game_winner = doc.get("game_winner") or None
+        self.log = doc.get("log") or []
+        self.log_count = doc.get("log_count") or len(self.log)
+        self.log_cleared = False
+        self.assigned_players = doc.get("assigned_players") or []
+        self.player_keys = doc.get("player_keys") or {}
+        self.state_cache = {}
+        self.patch_cache = {}
+        self.state_history = OrderedDict()
+        self.publish(self.to_document(), doc.get("version") or 0)
+
+    def publish(self, document, version):
+        # Moves change the attributes in place, readers only ever see a
+        # committed copy, swapped in whole together with its version
+        document["version"] = version
+        self.saved_document = document
+        self.version = version
+
+    def to_document(self):
+        return copy.deepcopy({
+            "players": self.players,
+            "game_started": self.game_started,
+            "card_pile": self.card_pile,
+            "current_turn_index": self.current_turn_index,
+            "player_order": self.player_order,
+            "reference_card": self.reference_card,
+            "last_play": self.last_play,
+            "game_winner": self.game_winner,
+            "log": self.log,
+            "log_count": self.log_count,
+            "assigned_players": self.assigned_players,
+            "player_keys": self.player_keys
+        })
+
+    def sync_state(self, force=False):
+        # Reads are served from memory, only rehydrate when the stored version moved.
+        # Moves force the check, they must not be judged against a stale state
+        now = time.monotonic()
+        if not force and now - self.last_sync < SYNC_INTERVAL:
+            return
+        self.last_sync = now
+        if (self.call_store("get_version") or 0) != self.version:
+            # A move in progress owns the state and will reload it itself if it has to
+            if not self.move_lock.lock.acquire(blocking=False):
+                return
+            try:
+                self.reload_state_from_db()
+            finally:
+                self.move_lock.lock.release()
+
+    def commit(self):
+        # The log is appended to, it is only rewritten when a new game clears it
+        new_entries = self.log_count - self.saved_document["log_count"]
+        log_entries = self.log[-new_entries:] if new_entries else []
+        del self.log[:-LOG_TAIL]
+
+        # Persist only the fields the move touched, guarded by the version we loaded
+        document = self.to_document()
+        changes = {k: v for k, v in document.items() if k != "log" and v != self.saved_document.get(k)}
+        if log_entries:
+            changes["log_entries"] = log_entries
+        if self.log_cleared:
+            changes["log"] = document["log"]
+
+        if not changes:
+            return
+        # One write per move, the id lets the store recognise a retried write
+        version = self.call_store("save_game", changes, self.version, uuid.uuid4().hex)
+        self.log_cleared = False
+        self.state_cache = {}
+        self.patch_cache = {}
+        self.publish(document, version)
+        self.notify_change()
+
+    def apply_move(self, move, *args):
+        name = move.__name__[len("do_"):]
+        with self.move_lock:
+            round_trips = metrics.round_trip_count()
+            result = None
+            try:
+                with metrics.move_duration.time(name):
+                    result = self.run_move(move, *args)
+                return result
+            finally:
+                outcome = "exception" if result is None else result.get("status", "OK").lower()
+                metrics.moves.inc(name, outcome)
+                metrics.move_round_trips.observe(metrics.round_trip_count() - round_trips, name)
+
+    def run_move(self, move, *args):
+        for _ in range(MAX_COMMIT_ATTEMPTS):
+            self.sync_state(force=True)
+            try:
+                result = move(*args)
+            except Exception:
+                # Drop the half-applied move instead of committing it later
+                self.reload_state_from_db()
+                raise
+            try:
+                self.commit()
+                return result
+            except VersionConflict:
+                # Another process moved the game first, replay on its state
+                self.reload_state_from_db()
+            except Exception:
+                # The write failed, what is stored is still the last committed state
+                self.reload_state_from_db()
+                raise
+        return {"status": "ERROR", "message": "Game is busy, please try again."}
 
     def join_game(self):
-        self.reload_state_from_db()
+        return self.apply_move(self.do_join_game)
+
+    def start_game(self):
+        return self.apply_move(self.do_start_game)
+
+    def play_card(self, player_id, cards_played, key=None):
+        return self.apply_move(self.do_play_card, player_id, cards_played, key)
 
+    def challenge(self, challenger_id, key=None):
+        return self.apply_move(self.do_challenge, challenger_id, key)
+
+    def do_join_game(self):
         if len(self.assigned_players) >= 4:
             return {"status": "ERROR", "message": "Game is full."}
 
@@ -33,279 +231,140 @@ class LiarDeckGame:
         for player_id in all_possible_players:
             if player_id not in self.assigned_players:
                 self.assigned_players.append(player_id)
-                mongodb.set_assigned_players(self.assigned_players)
                 player_key = self.generate_player_key()
-                mongodb.set_player_key(player_id, player_key)
+                self.player_keys[player_id] = player_key
 
                 self.add_to_log(f"{player_id} has joined the lobby.")
                 return {"status": "OK", "player_id": player_id, "key": player_key}
 
         return {"status": "ERROR", "message": "Could not assign player ID."}
 
-    def start_game(self):
-        mongodb.reset_new_game_state()
-
-        self.player_order = self.assigned_players
-
-        mongodb.set_player_order(self.player_order)
-        mongodb.set_assigned_players(self.player_order)
-
-        if len(self.player_order) < 2:
-            self.log = ["Waiting for more players to join..."]
-            mongodb.set_log(self.log)
-            return {"status": "ERROR", "message": "Need at least 2 players to start."}
-
-        deck = self.shuffle_deck()
-
-        num_players = len(self.player_order)
-        cards_per_player = len(deck) // num_players
-
-        for i, player_id in enumerate(self.player_order):
-            player_key = mongodb.get_player_key(player_id)
-            print(f"Assigning player {player_id} with key {player_key}")
-            self.players[player_id] = {
-                "hand": deck[i * cards_per_player: (i + 1) * cards_per_player],
-                "roulette_index": 0,
-                "roulette": random.randint(0, 2),
-                "key": mongodb.get_player_key(player_id),
-                "is_eliminated": False
-            }
-            mongodb.insert_player_data(player_id, self.players[player_id])
-
-        self.game_started = True
-        mongodb.set_game_state(True)
-        self.current_turn_index = 0
-        mongodb.set_current_turn_index(self.current_turn_index)
-
-        self.log = []  # Reset log for new game
-        self.add_to_log(f"Game started with {num_players} players.")
-        self.add_to_log(f"Reference card is {self.reference_card}.")
-        self.add_to_log(f"It's {self.player_order[self.current_turn_index]}'s turn.")
-
-        return {"status": "OK", "message": "Game started successfully."}
-
-    def generate_new_deck(self):
-        deck = self.shuffle_deck()
-
-        active_players = [p for p in self.player_order if not self.players.get(p, {}).get("is_eliminated")]
-        num_active_players = len(active_players)
-        if num_active_players == 0: return
-
-        cards_per_player = len(deck) // num_active_players
-
-        for i, player_id in enumerate(active_players):
-            self.players[player_id]["hand"] = deck[i * cards_per_player: (i + 1) * cards_per_player]
-            mongodb.update_player_hand(player_id, self.players[player_id]["hand"])
-
-    def shuffle_deck(self):
-        ranks = ["Ace", "Jack", "Queen", "King"]
-        deck = [rank for rank in ranks for _ in range(6)]
-        random.shuffle(deck)
-        self.reference_card = random.choice(ranks)
-        mongodb.set_reference_card(self.reference_card)
-        return deck
+    def do_start_game(self):
+        # The lobby and player keys are kept across rounds
+        return self.start_round(self.assigned_players, self.player_keys)
 
     def get_game_state(self, player_id, key=None):
-        self.reload_state_from_db()
+        self.sync_state()
+        return self.build_state(self.saved_document, player_id, key)
 
-        if not self.game_started:
+    def build_state(self, doc, player_id, key=None):
+        # Built from one committed document, never from the state a move is changing
+        if not doc["game_started"]:
             return {
                 "game_started": False,
-                "assigned_players": self.assigned_players,
-                "log": self.log,
+                "assigned_players": doc["assigned_players"],
+                "log": doc["log"],
+                "version": doc["version"],
                 "message": "Game has not started. Waiting in lobby."
             }
 
-        player_data = mongodb.get_player_data(player_id)
+        all_players = doc["players"]
+        player_data = all_players.get(player_id)
 
         if key:
-            if not self.verify_player_key(player_id, key):
-                return {"status": "ERROR", "game_started": self.game_started, "error": "Invalid player key."}
+            player_key = doc["player_keys"].get(player_id)
+            if not player_key or player_key != key:
+                return {"status": "ERROR", "game_started": True, "error": "Invalid player key."}
 
         if not player_data:
-            return {"status": "ERROR", "game_started": self.game_started, "error": "Player not found in this game."}
-
-        all_players = mongodb.get_all_players_data()
+            return {"status": "ERROR", "game_started": True, "error": "Player not found in this game."}
 
+        player_order = doc["player_order"]
         state = {
             "game_started": True,
             "is_eliminated": player_data.get("is_eliminated", False),
-            "your_hand": player_data.get("hand", []),
+            "your_hand": expand_cards(player_data["hand"]),
             "roulette_index": player_data.get("roulette_index", 0),
-            "all_players_card_count": {pid: len(p.get("hand", [])) for pid, p in all_players.items()},
+            "all_players_card_count": {pid: sum(p["hand"]) for pid, p in all_players.items()},
             "players_eliminated": [pid for pid, p in all_players.items() if p.get("is_eliminated")],
-            "card_pile_count": len(self.card_pile),
-            "current_turn": self.player_order[self.current_turn_index] if self.player_order else None,
-            "reference_card": self.reference_card,
-            "game_winner": self.game_winner,
-            "log": self.log[-5:]
+            "card_pile_count": sum(doc["card_pile"]),
+            "current_turn": player_order[doc["current_turn_index"]] if player_order else None,
+            "reference_card": doc["reference_card"],
+            "game_winner": doc["game_winner"],
+            "log": doc["log"][-5:],
+            "version": doc["version"]
         }
         return state
 
-    def next_turn(self, set_turn_to_player=None):
-        # self.reload_state_from_db()
-        active_players = [p for p in self.player_order if not self.players.get(p, {}).get("is_eliminated")]
-
-        if not active_players or len(active_players) <= 1:
-            self.game_winner = active_players[0] if active_players else "No one"
-            mongodb.set_game_winner(self.game_winner)
-            self.add_to_log(f"Game over! Winner is {self.game_winner}")
-            return
-
-        all_hands_empty = all(len(self.players[p].get("hand", [])) == 0 for p in active_players)
-        if all_hands_empty:
-            self.generate_new_deck()
-            self.add_to_log("All players have no cards left. New deck generated.")
-
-        if set_turn_to_player and not self.players.get(set_turn_to_player, {}).get("is_eliminated"):
-            self.current_turn_index = self.player_order.index(set_turn_to_player)
-        else:
-            current_player_id = self.player_order[self.current_turn_index]
-
-            next_index = (self.player_order.index(current_player_id) + 1) % len(self.player_order)
-
-            while self.players.get(self.player_order[next_index], {}).get("is_eliminated"):
-                next_index = (next_index + 1) % len(self.player_order)
-            self.current_turn_index = next_index
-
-        if len(self.players[self.player_order[self.current_turn_index]].get("hand", [])) == 0:
-            print("Setting game winner due to no cards left.")
-            winner = self.player_order[self.current_turn_index]
-            self.set_game_winner(winner)
-            return {"status": "OK", "message": f"No cards left to play. {winner} is the winner!"}
-
-        # if set_turn_to_player:
-        #     for pid in self.players:
-        #         if len(self.players[pid].get("hand", [])) == 0:
-        #             self.set_game_winner(pid)
-        #             return {"status": "OK", "message": f"{pid} has no cards left. Game over!"}
-
-        mongodb.set_current_turn_index(self.current_turn_index)
-        self.add_to_log(f"It's {self.player_order[self.current_turn_index]}'s turn.")
-
-    def play_card(self, player_id, cards_played, key=None):
-        self.reload_state_from_db()
+    def cached_state(self, player_id):
+        # (version, state, serialized state), built once per player per version
+        self.sync_state()
+        doc = self.saved_document
+        version = doc["version"]
+        if doc["game_started"] and player_id not in doc["players"]:
+            # Error reply, not worth a cache slot per made-up id
+            state = self.build_state(doc, player_id)
+            return version, state, json.dumps(state).encode()
+        # Everyone sees the same lobby
+        cache_key = player_id if doc["game_started"] else None
+        cached = self.state_cache.get(cache_key)
+        if cached is not None and cached[0] == version:
+            return cached
+        # The document is never changed once published, so the state can share its lists
+        state = self.build_state(doc, player_id)
+        cached = (version, state, json.dumps(state).encode())
+        self.state_cache[cache_key] = cached
+        self.state_history[(cache_key, version)] = state
+        while len(self.state_history) > STATE_HISTORY_SIZE:
+            self.state_history.popitem(last=False)
+        return cached
+
+    def get_game_state_json(self, player_id):
+        """get_game_state serialized to bytes, built once per player per version."""
+        return self.cached_state(player_id)[2]
+
+    def get_game_state_patch(self, player_id, since):
+        """Serialized fields that changed for player_id after version since.
+
+        Returns None when nothing changed, and the full state when since is
+        too old (or from another process) to diff against.
+        """
+        version, state, body = self.cached_state(player_id)
+        if since == version:
+            return None
+        cache_key = player_id if state["game_started"] else None
+        cached = self.patch_cache.get((cache_key, since))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        previous = self.state_history.get((player_id, since)) or self.state_history.get((None, since))
+        if previous is None or previous.keys() != state.keys():
+            return body
+        changes = {k: v for k, v in state.items() if k != "version" and previous[k] != v}
+        patch = json.dumps({"since": since, "version": version, "changes": changes}).encode()
+        self.patch_cache[(cache_key, since)] = (version, patch)
+        return patch
+
+    def do_play_card(self, player_id, cards_played, key=None):
         if self.player_order[self.current_turn_index] != player_id:
             return {"status": "ERROR", "message": "Not your turn."}
 
         if key and not self.verify_player_key(player_id, key):
             return {"status": "ERROR", "message": "Invalid player key."}
 
-        for player in self.player_order:
-            if (len(self.players.get(player, {}).get("hand", [])) == 0 and
-                    not self.players[player].get("is_eliminated", False)):
-                self.set_game_winner(player)
-                return {"status": "OK", "message": f"{player} has no cards left. Game over!"}
-
-        player_hand = self.players.get(player_id, {}).get("hand", [])
-
-        # Verify cards are in hand before removing
-        temp_hand = list(player_hand)
-        for card in cards_played:
-            if card in temp_hand:
-                temp_hand.remove(card)
-            else:
-                return {"status": "ERROR", "message": f"You don't have a {card}."}
-
-        # If verification passes, update hand
-        self.players[player_id]["hand"] = temp_hand
-        mongodb.update_player_hand(player_id, temp_hand)
-
-        self.card_pile.extend(cards_played)
-        mongodb.set_card_pile(self.card_pile)
-
-        mongodb.set_last_play(player_id, cards_played)
-        self.last_play = {"player_id": player_id, "cards": cards_played}
-
-        self.add_to_log(f"{player_id} played {len(cards_played)} card(s).")
-        self.next_turn()
-        return {"status": "OK"}
-
-    def set_game_winner(self, player_id):
-        # self.reload_state_from_db()
-        if player_id not in self.players or self.players[player_id]["is_eliminated"]:
-            return {"status": "ERROR", "message": "Player not found or already eliminated."}
-
-        self.game_winner = player_id
-        print("Game winner set to:", self.game_winner)
-        mongodb.set_game_winner(self.game_winner)
-        self.add_to_log(f"Game over! Winner is {self.game_winner}")
-
-    def kill_player(self, player_id):
-        # self.reload_state_from_db()
-        if player_id not in self.players or self.players[player_id]["is_eliminated"]:
-            return {"status": "ERROR", "message": "Player not found or already eliminated."}
-
-        self.players[player_id]["is_eliminated"] = True
-        mongodb.set_player_killed(player_id)
-        self.add_to_log(f"{player_id} has been eliminated.")
-
-        # Check for winner
-        active_players = [p for p in self.player_order if not self.players.get(p, {}).get("is_eliminated")]
-        if len(active_players) == 1:
-            self.game_winner = active_players[0]
-            mongodb.set_game_winner(self.game_winner)
-            self.add_to_log(f"Game over! Winner is {self.game_winner}")
-
-    def proceed_roulette(self, player_id):
-        # self.reload_state_from_db()
-        player_data = self.players.get(player_id)
-        if not player_data: return
-
-        roulette_index = player_data["roulette_index"]
-        bullet_position = player_data["roulette"]
-
-        if roulette_index == bullet_position:
-            self.add_to_log(f"{player_id} pulls the trigger... BANG!")
-            self.kill_player(player_id)
-        else:
-            player_data["roulette_index"] += 1
-            mongodb.set_roulette_index(player_id, player_data["roulette_index"])
-            self.add_to_log(f"{player_id} survived the roulette! Index is now {player_data['roulette_index']}.")
-
-    def challenge(self, challenger_id, key=None):
-        self.reload_state_from_db()
+        return self.play_cards(player_id, cards_played)
 
+    def do_challenge(self, challenger_id, key=None):
         if not self.last_play or not self.last_play["player_id"]:
             return {"status": "ERROR", "message": "No play to challenge."}
 
         if key and not self.verify_player_key(challenger_id, key):
             return {"status": "ERROR", "message": "Invalid player key."}
 
-        player_who_played = self.last_play["player_id"]
-        cards_in_play = self.last_play["cards"]
+        return self.resolve_challenge(challenger_id)
 
-        is_a_lie = any(card != self.reference_card for card in cards_in_play)
-
-        if is_a_lie:
-            winner, loser = challenger_id, player_who_played
-            self.add_to_log(f"{challenger_id} challenges {player_who_played}... and was RIGHT!")
-            self.proceed_roulette(loser)
-        else:
-            winner, loser = player_who_played, challenger_id
-            self.add_to_log(f"{challenger_id} challenges {player_who_played}... and was WRONG!")
-            self.proceed_roulette(loser)
-
-        self.card_pile = []
-
-        mongodb.set_card_pile([])
-        mongodb.set_last_play(None, [])  # Clear last play after challenge
-
-        self.generate_new_deck()
-        self.next_turn(set_turn_to_player=winner)
-        return {"status": "OK", "challenge_winner": winner, "challenge_loser": loser}
-
-    def add_to_log(self, message):
-        current_log = mongodb.get_log() or []
-        current_log.append(message)
-        mongodb.set_log(current_log)
-        self.log = current_log
+    def get_log_page(self, after=0, limit=50):
+        entries = self.call_store("get_log_page", after, limit)
+        return {
+            "entries": entries,
+            "next": entries[-1]["seq"] if entries else after
+        }
 
     def generate_player_key(self):
         return ''.join(random.choices(string.ascii_letters + string.digits, k=32))
 
     def verify_player_key(self, player_id, key):
-        player_data = mongodb.get_player_data(player_id)
-        if not player_data:
+        player_key = self.player_keys.get(player_id)
+        if not player_key:
             return False
-        return player_data.get("key") == key
\ No newline at end of file
+        return player_key == key
\ No newline at end of file
@@ -1,9 +1,289 @@
+import asyncio
 import json
+import logging
+import math
+import re
+import traceback
 from datetime import datetime
-from game_logic import LiarDeckGame
+from storage import create_store, StorageUnavailable
+from rooms import RoomRegistry, DEFAULT_ROOM
+from game_logic import SYNC_INTERVAL
+from static_files import StaticFiles
+from admission import RateLimiter, STATE_RATE_LIMIT, STATE_RATE_BURST, TRUSTED_PROXIES, RETRY_AFTER, retry_after
+import metrics
 import os
+import time
+from urllib.parse import parse_qsl, unquote
 
-game = LiarDeckGame()
+rooms = RoomRegistry()
+if hasattr(os, 'register_at_fork'):
+    # Forked worker processes start with an empty registry and their own Mongo client
+    os.register_at_fork(after_in_child=rooms.clear)
+
+# Persistent connection limits, advertised in the Keep-Alive response header
+KEEP_ALIVE_TIMEOUT = 15
+MAX_KEEP_ALIVE_REQUESTS = 100
+
+# A long-poll returns 204 after this long and the client simply asks again
+MAX_SUBSCRIBE_TIMEOUT = 30
+# Comment lines keep idle event streams (and proxies in between) alive
+SSE_HEARTBEAT_INTERVAL = 15
+SSE_PING = b": ping\n\n"
+
+
+# Paths reported under their own name in /metrics, anything else is counted as static
+METRIC_PATHS = {
+    '/health', '/metrics', '/metrics/profile', '/game/state', '/game/subscribe', '/game/events', '/game/log',
+    '/game/stats', '/game/join', '/game/start', '/game/play', '/game/challenge',
+}
+
+
+# Anything bigger is refused before it is buffered any further
+MAX_HEADER_SIZE = 16 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+CHUNK_SIZE = re.compile(rb"[0-9A-Fa-f]{1,16}")
+
+
+class RequestError(Exception):
+    """A request that cannot be parsed, answered with kode and the connection closed."""
+
+    def __init__(self, kode, message):
+        super().__init__(message)
+        self.kode = kode
+        self.message = message
+
+
+class Request:
+    def __init__(self, method, target, version, headers):
+        # Address of the peer, set by RequestParser when it knows it
+        self.client = None
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.body = b""
+        # The request exactly as received, for forwarding
+        self.raw = b""
+
+        path, _, query = target.partition('?')
+        self.path = unquote(path)
+        self.params = dict(parse_qsl(query, keep_blank_values=True))
+
+    @classmethod
+    def from_head(cls, head):
+        lines = head.split('\r\n')
+        request_line = lines[0].split(' ')
+        if len(request_line) != 3 or not request_line[2].startswith('HTTP/'):
+            raise RequestError(400, 'Bad Request')
+
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise RequestError(400, 'Bad Request')
+            name = name.strip().lower()
+            value = value.strip()
+            # Repeated headers fold into one comma separated value
+            headers[name] = f"{headers[name]}, {value}" if name in headers else value
+        return cls(request_line[0].upper(), request_line[1], request_line[2].upper(), headers)
+
+    @property
+    def chunked(self):
+        return 'chunked' in self.headers.get('transfer-encoding', '').lower()
+
+    @property
+    def content_length(self):
+        try:
+            length = int(self.headers.get('content-length', 0))
+        except ValueError:
+            raise RequestError(400, 'Bad Request')
+        if length < 0:
+            raise RequestError(400, 'Bad Request')
+        return length
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+class RequestParser:
+    """Incremental parser for one connection, fed with whatever recv() returns.
+
+    Bytes accumulate in a single bytearray and are only sliced out once a
+    whole request is there. Anything after it (a pipelined request) stays
+    buffered for the next call to next().
+    """
+
+    def __init__(self, max_header_size=MAX_HEADER_SIZE, max_body_size=MAX_BODY_SIZE, client=None):
+        self.client = client
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.buffer = bytearray()
+        self.reset()
+
+    def reset(self):
+        # Request whose head is parsed but whose body is still arriving
+        self.request = None
+        self.scanned = 0
+        self.pos = 0
+        self.chunks = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next(self):
+        """Return the next complete Request, or None until more data is fed."""
+        if self.request is None:
+            # Resume the search where the last one stopped, minus a partial terminator
+            header_end = self.buffer.find(b"\r\n\r\n", max(0, self.scanned - 3))
+            if header_end == -1:
+                self.scanned = len(self.buffer)
+                if self.scanned > self.max_header_size:
+                    raise RequestError(431, 'Request Header Fields Too Large')
+                return None
+            if header_end > self.max_header_size:
+                raise RequestError(431, 'Request Header Fields Too Large')
+            with memoryview(self.buffer) as view:
+                self.request = Request.from_head(str(view[:header_end], 'latin-1'))
+            self.request.client = self.client
+            self.pos = header_end + 4
+            if not self.request.chunked and self.request.content_length > self.max_body_size:
+                raise RequestError(413, 'Payload Too Large')
+
+        request = self.request
+        if request.chunked:
+            if not self.read_chunks():
+                return None
+            request.body = bytes(self.chunks)
+        else:
+            body_end = self.pos + request.content_length
+            if len(self.buffer) < body_end:
+                return None
+            with memoryview(self.buffer) as view:
+                request.body = bytes(view[self.pos:body_end])
+            self.pos = body_end
+
+        with memoryview(self.buffer) as view:
+            request.raw = bytes(view[:self.pos])
+        del self.buffer[:self.pos]
+        self.reset()
+        return request
+
+    def read_chunks(self):
+        while True:
+            line_end = self.buffer.find(b"\r\n", self.pos)
+            if line_end == -1:
+                return False
+            size_field = bytes(self.buffer[self.pos:line_end].split(b';', 1)[0])
+            # Hex digits only, int() would also take a sign, 0x, underscores and spaces
+            if not CHUNK_SIZE.fullmatch(size_field):
+                raise RequestError(400, 'Bad Request')
+            size = int(size_field, 16)
+
+            if size == 0:
+                # Optional trailers, then an empty line
+                trailer_end = self.buffer.find(b"\r\n\r\n", line_end)
+                if trailer_end == -1:
+                    return False
+                self.pos = trailer_end + 4
+                return True
+
+            data_start = line_end + 2
+            data_end = data_start + size
+            if len(self.buffer) < data_end + 2:
+                return False
+            if self.buffer[data_end:data_end + 2] != b"\r\n":
+                raise RequestError(400, 'Bad Request')
+            if len(self.chunks) + size > self.max_body_size:
+                raise RequestError(413, 'Payload Too Large')
+            with memoryview(self.buffer) as view:
+                self.chunks += view[data_start:data_end]
+            self.pos = data_end + 2
+
+
+class StateSubscription:
+    """A /game/subscribe or /game/events request waiting for the game version to move.
+
+    HttpServer.proses hands this back instead of response bytes, so an idle
+    subscriber does not hold a thread. The threaded server parks the
+    connection and calls render()/event() once something is due, the
+    asyncio server awaits the *_async variants. Those still build the
+    state on executor, it may have to go to storage.
+    """
+
+    def __init__(self, httpserver, game, player_id, since, timeout, stream):
+        self.httpserver = httpserver
+        self.game = game
+        self.player_id = player_id
+        self.since = since
+        self.timeout = timeout
+        self.stream = stream
+        self.keep_alive = False
+
+    def render(self, version):
+        if version == self.since:
+            hasil = self.httpserver.response(204, 'No Content')
+        else:
+            hasil = self.httpserver.response(200, 'OK', self.game.get_game_state_json(self.player_id))
+        return self.httpserver.finish(hasil, self.keep_alive)
+
+    async def respond_async(self, executor):
+        version = await self.wait_async(self.since, self.timeout, executor)
+        return await asyncio.get_running_loop().run_in_executor(executor, self.render, version)
+
+    def stream_head(self):
+        tanggal = datetime.now().strftime('%c')
+        return (
+            "HTTP/1.1 200 OK\r\n"
+            f"Date: {tanggal}\r\n"
+            "Connection: keep-alive\r\n"
+            "Server: MyLiarDeckServer/1.0\r\n"
+            "Content-Type: text/event-stream\r\n"
+            "Cache-Control: no-cache\r\n"
+            "Access-Control-Allow-Origin: *\r\n"
+            "\r\n"
+        ).encode()
+
+    def event(self):
+        # The id is the version the state was built from, a move may have landed since
+        self.since, _, state = self.game.cached_state(self.player_id)
+        return f"id: {self.since}\ndata: ".encode() + state + b"\n\n"
+
+    async def events_async(self, executor):
+        loop = asyncio.get_running_loop()
+        yield await loop.run_in_executor(executor, self.event)
+        while True:
+            if await self.wait_async(self.since, SSE_HEARTBEAT_INTERVAL, executor) == self.since:
+                yield SSE_PING
+            else:
+                yield await loop.run_in_executor(executor, self.event)
+
+    async def wait_async(self, since, timeout, executor):
+        loop = asyncio.get_running_loop()
+        woken = asyncio.Event()
+
+        def on_change(version):
+            loop.call_soon_threadsafe(woken.set)
+
+        self.game.watchers.append(on_change)
+        try:
+            deadline = loop.time() + timeout
+            while self.game.version == since:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(woken.wait(), min(remaining, SYNC_INTERVAL))
+                except asyncio.TimeoutError:
+                    # Moves made by other processes only show up through the version check
+                    await loop.run_in_executor(executor, self.game.sync_state)
+                woken.clear()
+        finally:
+            self.game.watchers.remove(on_change)
+        return self.game.version
 
 
 class HttpServer:
@@ -16,6 +296,8 @@ class HttpServer:
         self.types['.html'] = 'text/html'
         self.types['.js'] = 'application/javascript'
         self.types['.css'] = 'text/css'
+        self.static = StaticFiles('www', self.types)
+        self.state_limiter = RateLimiter(STATE_RATE_LIMIT, STATE_RATE_BURST) if STATE_RATE_LIMIT > 0 else None
 
     def response(self, kode=404, message='Not Found', messagebody='', headers={}):
         if isinstance(messagebody, dict) or isinstance(messagebody, list):
@@ -31,6 +313,7 @@ class HttpServer:
         headers['Access-Control-Allow-Origin'] = '*'
         headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
         headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        headers['Access-Control-Expose-Headers'] = 'Retry-After'
 
         tanggal = datetime.now().strftime('%c')
         resp = []
@@ -46,76 +329,178 @@ class HttpServer:
         response_headers = "".join(resp)
         return response_headers.encode() + messagebody
 
-    def proses(self, data):
-        requests = data.split("\r\n")
-        baris = requests[0]
+    def proses(self, request, keep_alive=False):
+        started = time.perf_counter()
+        hasil = self.route(request)
+        path = request.path if request.path in METRIC_PATHS else 'static'
+        if isinstance(hasil, StateSubscription):
+            # Event streams own the connection until the client goes away
+            hasil.keep_alive = keep_alive and not hasil.stream
+            metrics.http_requests.observe(time.perf_counter() - started, request.method, path, 'stream')
+            return hasil
+        metrics.http_requests.observe(time.perf_counter() - started, request.method, path, hasil[9:12].decode())
+        return self.finish(hasil, keep_alive)
 
-        body_start_index = data.find('\r\n\r\n') + 4
-        body = data[body_start_index:]
+    def finish(self, hasil, keep_alive):
+        if keep_alive:
+            # Every response is built with "Connection: close", swap it in the header block
+            hasil = hasil.replace(
+                b"\r\nConnection: close\r\n",
+                f"\r\nConnection: keep-alive\r\nKeep-Alive: timeout={KEEP_ALIVE_TIMEOUT}, max={MAX_KEEP_ALIVE_REQUESTS}\r\n".encode(),
+                1
+            )
+        return hasil
 
-        j = baris.split(" ")
-        try:
-            method = j[0].upper().strip()
-            object_address = j[1].strip()
-
-            # Handle OPTIONS pre-flight request for CORS
-            if method == 'OPTIONS':
-                return self.response(204, 'No Content', headers={
-                    'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                    'Access-Control-Allow-Headers': 'Content-Type'
-                })
-
-            elif method == 'GET':
-                parts = object_address.split('?')
-                path = parts[0]
-                params = {}
-                if len(parts) > 1:
-                    query_string = parts[1]
-                    params = dict(p.split('=') for p in query_string.split('&'))
-
-                return self.http_get(path, params)
-
-            elif method == 'POST':
-                return self.http_post(object_address, body)
-            else:
-                return self.response(400, 'Bad Request', {"error": "Method not supported"})
+    def route(self, request):
+        method = request.method
 
-        except IndexError:
-            return self.response(400, 'Bad Request', {"error": "Malformed request line"})
+        # Handle OPTIONS pre-flight request for CORS
+        if method == 'OPTIONS':
+            return self.response(204, 'No Content', headers={
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type'
+            })
 
-    def http_get(self, path, params):
-        if path == '/game/state':
-            player_id = params.get('player_id')
-            if not player_id:
-                # Fallback or error if no player_id is provided
-                state = game.get_game_state(None)  # Get a general state / lobby view
-            else:
-                state = game.get_game_state(player_id)
-            return self.response(200, 'OK', state)
+        elif method == 'GET':
+            if request.path == '/game/state' and self.state_limiter is not None:
+                wait = self.state_limiter.allow(self.client_key(request))
+                if wait:
+                    metrics.shed.inc("http", "rate_limit")
+                    return self.response(429, 'Too Many Requests', {"error": "Polling too fast, slow down"},
+                                         {'Retry-After': retry_after(wait)})
+            return self.http_get(request.path, request.params, request.headers)
+
+        elif method == 'POST':
+            return self.http_post(request.path, request.body)
         else:
+            return self.response(400, 'Bad Request', {"error": "Method not supported"})
+
+    def error_response(self, error):
+        return self.response(error.kode, error.message, {"error": error.message})
+
+    def overloaded_response(self):
+        return self.response(503, 'Service Unavailable', {"error": "Server busy, try again"},
+                             {'Retry-After': retry_after(RETRY_AFTER)})
+
+    def client_key(self, request):
+        # Behind the load balancer the peer is always the balancer, the real client is in X-Forwarded-For
+        client = request.client
+        forwarded = request.headers.get('x-forwarded-for')
+        if forwarded and client in TRUSTED_PROXIES:
+            # The balancer appends its header last, anything before it came from the client
+            client = forwarded.split(',')[-1].strip()
+        return f"{client} {request.params.get('room_id', '')} {request.params.get('player_id', '')}"
+
+    def http_get(self, path, params, headers={}):
+        if path == '/health':
+            # Also tells the load balancer when this worker cannot reach its storage
             try:
-                if path == '/':
-                    path = '/index.html'
+                create_store().ping()
+            except StorageUnavailable as e:
+                return self.response(503, 'Service Unavailable', {"status": "ERROR", "storage": str(e)})
+            return self.response(200, 'OK', {"status": "OK", "storage": "OK"})
+
+        if path == '/metrics':
+            # Prometheus text format, numbers of this process only
+            return self.response(200, 'OK', metrics.render(),
+                                 {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+        if path == '/metrics/profile':
+            if metrics.profiler is None:
+                return self.response(404, 'Not Found', {"error": "Profiler not running, see --profile-interval"})
+            return self.response(200, 'OK', metrics.profiler.report(),
+                                 {'Content-Type': 'text/plain; charset=utf-8'})
+
+        if path in ('/game/state', '/game/subscribe', '/game/events', '/game/log', '/game/stats'):
+            room_id = params.get('room_id', DEFAULT_ROOM)
+            if not rooms.is_valid_room_id(room_id):
+                return self.response(400, 'Bad Request', {"error": "Invalid room id"})
+            game = rooms.get(room_id)
+            player_id = params.get('player_id')
 
-                filepath = 'www' + path
-                with open(filepath, 'rb') as f:
-                    content = f.read()
+            if path == '/game/stats':
+                # How long moves in this room queue for the per-game write lock
+                return self.response(200, 'OK', {"room_id": room_id, "version": game.version,
+                                                 "move_lock": game.move_lock.stats(),
+                                                 "storage_calls": dict(game.store_calls)})
 
-                file_ext = os.path.splitext(filepath)[1]
-                content_type = self.types.get(file_ext, 'application/octet-stream')
+            if path == '/game/log':
+                # Full history, paged with the seq of the last entry already seen
+                try:
+                    after = int(params.get('after', 0))
+                    limit = max(1, min(int(params.get('limit', 50)), 200))
+                except ValueError:
+                    return self.response(400, 'Bad Request', {"error": "Invalid after or limit"})
+                return self.response(200, 'OK', game.get_log_page(after, limit))
 
-                return self.response(200, 'OK', content, {'Content-Type': content_type})
-            except FileNotFoundError:
+            if path != '/game/state':
+                try:
+                    since = int(params.get('since', -1))
+                    timeout = float(params.get('timeout', MAX_SUBSCRIBE_TIMEOUT))
+                except ValueError:
+                    return self.response(400, 'Bad Request', {"error": "Invalid since or timeout"})
+                if not math.isfinite(timeout):
+                    # A NaN deadline never passes and the wait would never end
+                    return self.response(400, 'Bad Request', {"error": "Invalid since or timeout"})
+                timeout = max(0.0, min(timeout, MAX_SUBSCRIBE_TIMEOUT))
+                return StateSubscription(self, game, player_id, since, timeout, path == '/game/events')
+
+            if 'since' in params:
+                # Only what changed after the version the client already has
+                try:
+                    since = int(params['since'])
+                except ValueError:
+                    return self.response(400, 'Bad Request', {"error": "Invalid since"})
+                patch = game.get_game_state_patch(player_id, since)
+                if patch is None:
+                    return self.response(304, 'Not Modified', b'')
+                return self.response(200, 'OK', patch)
+
+            # Serialized once per version and shared by every poller
+            return self.response(200, 'OK', game.get_game_state_json(player_id))
+        else:
+            if path == '/':
+                path = '/index.html'
+
+            filepath = self.static.resolve(path)
+            if filepath is None:
+                return self.response(403, 'Forbidden', {"error": "Path outside web root"})
+            asset = self.static.get(filepath)
+            if asset is None:
                 return self.response(404, 'Not Found', {"error": "File not found"})
 
+            asset_headers = {
+                'Content-Type': asset.content_type,
+                'ETag': asset.etag,
+                'Last-Modified': asset.last_modified,
+                'Cache-Control': 'no-cache',
+                'Vary': 'Accept-Encoding',
+            }
+            if asset.not_modified(headers):
+                return self.response(304, 'Not Modified', b'', asset_headers)
+
+            content = asset.content
+            if asset.gzipped is not None and 'gzip' in headers.get('accept-encoding', ''):
+                content = asset.gzipped
+                asset_headers['Content-Encoding'] = 'gzip'
+            return self.response(200, 'OK', content, asset_headers)
+
     def http_post(self, object_address, body):
         try:
             payload = json.loads(body) if body else {}
         except json.JSONDecodeError:
             return self.response(400, 'Bad Request', {"error": "Invalid JSON body"})
+        if not isinstance(payload, dict):
+            return self.response(400, 'Bad Request', {"error": "JSON body must be an object"})
+
+        room_id = payload.get("room_id", DEFAULT_ROOM)
+        if not rooms.is_valid_room_id(room_id):
+            return self.response(400, 'Bad Request', {"error": "Invalid room id"})
 
         try:
+            game = rooms.get(room_id)
+
             if object_address == '/game/join':
                 result = game.join_game()
                 if result.get("status") == "ERROR":
@@ -145,7 +530,6 @@ class HttpServer:
                 return self.response(404, 'Not Found', {"error": "Endpoint not found"})
 
         except Exception as e:
-            import traceback
             error_details = traceback.format_exc()
-            print(f"\n--- SERVER ERROR ---\n{error_details}\n---------------------\n")
+            logging.exception("Error handling POST", extra={"path": object_address, "room_id": room_id})
             return self.response(500, 'Internal Server Error', {"error": str(e), "details": error_details})
\ No newline at end of file
@@ -0,0 +1,168 @@
+"""Logging that stays off the request path.
+
+Handlers only put records on a bounded queue; one writer thread formats
+them and writes whole batches to stderr. When the queue is full records
+are dropped (and counted in /metrics) instead of blocking the request.
+Records logged with extra={"sampled": True} are per-connection noise and
+only LOG_SAMPLE_RATE of them are kept.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime, timezone
+import metrics
+
+LOG_QUEUE_SIZE = 10000
+# Records written per write() call at most
+MAX_BATCH = 500
+
+# Attributes every LogRecord has, anything else was passed with extra=
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and key != "sampled":
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s [%(process)d %(threadName)s] %(message)s")
+
+
+class SampleFilter(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, "sampled", False):
+            return random.random() < self.rate
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Only the cheap part happens here, the writer thread does the formatting
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.log_records_dropped.inc()
+
+
+class LogWriter(threading.Thread):
+    """Drains the queue and writes everything waiting in one go."""
+
+    def __init__(self, records, formatter, stream):
+        super().__init__(daemon=True, name="log-writer")
+        self.records = records
+        self.formatter = formatter
+        self.stream = stream
+
+    def run(self):
+        while True:
+            batch = [self.records.get()]
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            lines = []
+            for record in batch:
+                if record is None:
+                    continue
+                try:
+                    lines.append(self.formatter.format(record))
+                except Exception:
+                    metrics.log_records_dropped.inc()
+            if lines:
+                try:
+                    self.stream.write("\n".join(lines) + "\n")
+                    self.stream.flush()
+                except (OSError, ValueError):
+                    pass
+            if stop:
+                return
+
+    def stop(self, timeout=2):
+        try:
+            self.records.put_nowait(None)
+        except queue.Full:
+            return
+        self.join(timeout)
+
+
+handler = None
+writer = None
+
+
+def configure_logging(level=None, log_format=None, sample_rate=None, stream=None):
+    """Route the root logger through the queue, settings default to LOG_LEVEL, LOG_FORMAT and LOG_SAMPLE_RATE."""
+    global handler
+    level = (level or os.getenv('LOG_LEVEL', 'WARNING')).upper()
+    log_format = log_format or os.getenv('LOG_FORMAT', 'json')
+    if sample_rate is None:
+        sample_rate = float(os.getenv('LOG_SAMPLE_RATE', 0.01))
+
+    formatter = JsonFormatter() if log_format == 'json' else TextFormatter()
+    handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(SampleFilter(sample_rate))
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    start_writer(formatter, stream or sys.stderr)
+
+
+def start_writer(formatter, stream):
+    global writer
+    writer = LogWriter(handler.queue, formatter, stream)
+    writer.start()
+
+
+def stop_writer():
+    if writer is not None and writer.is_alive():
+        writer.stop()
+
+
+def restart_after_fork():
+    # The writer thread does not survive a fork, and the queue's locks may be held by it
+    if handler is not None:
+        handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+        start_writer(writer.formatter, writer.stream)
+
+
+atexit.register(stop_writer)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=restart_after_fork)
@@ -0,0 +1,219 @@
+"""In-process counters and histograms, exported in the Prometheus text format at /metrics.
+
+Each process keeps its own numbers: with --processes every worker reports
+only the requests it served itself.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter as FrameCounter
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+registry = []
+
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for label_values, value in items:
+            lines.extend(self.render_value(label_values, value))
+        return lines
+
+    def render_value(self, label_values, value):
+        return [f"{self.name}{format_labels(self.label_names, label_values)} {value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=(), collect=None):
+        super().__init__(name, help_text, labels)
+        # Sampled at scrape time instead of being kept up to date
+        self.collect = collect
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def render(self):
+        if self.collect is not None:
+            with self.lock:
+                self.values = {(): self.collect()}
+        return super().render()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += 1
+            series[2] += value
+
+    def time(self, *label_values):
+        return Timer(self, label_values)
+
+    def render_value(self, label_values, series):
+        bucket_counts, count, total = series
+        lines = []
+        for bound, bucket_count in zip(self.buckets, bucket_counts):
+            labels = format_labels(self.label_names, label_values, [f'le="{bound}"'])
+            lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+        labels = format_labels(self.label_names, label_values, ['le="+Inf"'])
+        lines.append(f"{self.name}_bucket{labels} {count}")
+        plain = format_labels(self.label_names, label_values)
+        lines.append(f"{self.name}_count{plain} {count}")
+        lines.append(f"{self.name}_sum{plain} {total:.6f}")
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+
+# Round trips to the database made by the current thread, so a move can tell how many it needed
+round_trips = threading.local()
+
+
+def count_round_trip():
+    round_trips.count = getattr(round_trips, 'count', 0) + 1
+
+
+def round_trip_count():
+    return getattr(round_trips, 'count', 0)
+
+
+http_requests = Histogram("liar_http_request_duration_seconds", "Time to build a response, by endpoint",
+                          ["method", "path", "status"])
+active_connections = Gauge("liar_active_connections", "Client connections being served", ["server"])
+active_threads = Gauge("liar_threads", "Live threads in this process", collect=threading.active_count)
+moves = Counter("liar_moves_total", "Moves applied, by outcome", ["move", "result"])
+move_duration = Histogram("liar_move_duration_seconds", "Time to apply and commit a move", ["move"])
+move_lock_wait = Histogram("liar_move_lock_wait_seconds", "Time a move queued for its game's write lock")
+move_round_trips = Histogram("liar_move_round_trips", "Database round trips needed by one move", ["move"],
+                             buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16, 24, 32))
+storage_calls = Histogram("liar_storage_call_duration_seconds", "GameStore calls made by the game logic",
+                          ["operation"])
+mongo_commands = Histogram("liar_mongo_command_duration_seconds", "Commands sent to MongoDB", ["command", "result"])
+upstream_selected = Counter("liar_lb_upstream_selected_total", "Requests the load balancer sent to each worker",
+                            ["upstream"])
+queued_connections = Gauge("liar_queued_connections", "Accepted connections waiting for a thread", ["server"])
+parked_connections = Gauge("liar_parked_connections", "Connections waiting without a thread: idle, long-polls, streams",
+                           ["server"])
+shed = Counter("liar_shed_total", "Connections and requests turned away under load", ["server", "reason"])
+log_records_dropped = Counter("liar_log_records_dropped_total", "Log records lost because the log queue was full")
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class Profiler(threading.Thread):
+    """Samples the stack of every thread and counts where they are, for /metrics/profile."""
+
+    def __init__(self, interval):
+        super().__init__(daemon=True, name="profiler")
+        self.interval = interval
+        # Written by the sampling thread, read by /metrics/profile requests
+        self.lock = threading.Lock()
+        self.samples = FrameCounter()
+        self.total = 0
+
+    def run(self):
+        own = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            locations = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                code = frame.f_code
+                locations.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+            with self.lock:
+                self.samples.update(locations)
+                self.total += len(locations)
+
+    def report(self, limit=50):
+        with self.lock:
+            samples = FrameCounter(self.samples)
+            total = self.total
+        lines = [f"# {total} samples every {self.interval}s"]
+        for location, count in samples.most_common(limit):
+            lines.append(f"{count}\t{count / total:.1%}\t{location}")
+        return "\n".join(lines) + "\n"
+
+
+profiler = None
+
+
+def start_profiler(interval):
+    global profiler
+    if profiler is None:
+        profiler = Profiler(interval)
+        profiler.start()
+    return profiler
+
+
+def forget_parent():
+    # A forked worker starts from zero, and the profiler thread did not survive the fork
+    global profiler
+    profiler = None
+    for metric in registry:
+        metric.lock = threading.Lock()
+        metric.values = {}
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=forget_parent)
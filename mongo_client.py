@@ -1,234 +1,396 @@
-from pymongo import MongoClient as PyMongoClient
-from dotenv import load_dotenv
+from pymongo import MongoClient as PyMongoClient, ReturnDocument, ASCENDING, UpdateOne, monitoring
+from pymongo.errors import AutoReconnect, DuplicateKeyError, PyMongoError
+from storage import GameStore, VersionConflict, StorageUnavailable, LOG_TAIL
+import metrics
 import os
-
-
-class MongoClient:
-    def __init__(self):
-        load_dotenv()
-        mongo_connection_string = os.getenv('MONGO_CONNECTION_STRING')
-        self.mongo_client = PyMongoClient(mongo_connection_string)
-
-    def set_game_state(self, game_state):
-        self.mongo_client.liar_decks.game_data.update_one(
-            {"_id": "game_state"},
-            {"$set": {"value": game_state}},
-            upsert=True
-        )
-
-    def get_game_state(self):
-        doc = self.mongo_client.liar_decks.game_data.find_one({"_id": "game_state"})
-        if doc:
-            return True if doc["value"] else False
-        return None
-
-    def set_card_pile(self, card_pile):
-        self.mongo_client.liar_decks.game_data.update_one(
-            {"_id": "card_pile"},
-            {"$set": {"value": card_pile}},
-            upsert=True
-        )
-
-    def get_card_pile(self):
-        doc = self.mongo_client.liar_decks.game_data.find_one({"_id": "card_pile"})
-        if doc:
-            return doc["value"]
-        return None
-
-    def set_reference_card(self, reference_card):
-        self.mongo_client.liar_decks.game_data.update_one(
-            {"_id": "reference_card"},
-            {"$set": {"value": reference_card}},
-            upsert=True
-        )
-
-    def get_reference_card(self):
-        doc = self.mongo_client.liar_decks.game_data.find_one({"_id": "reference_card"})
-        if doc:
-            return doc["value"]
+import threading
+
+# One pymongo client (and connection pool) is shared by every room
+connection_lock = threading.Lock()
+connections = {}
+indexed = set()
+# Whether each connection's deployment can run multi-document transactions
+transactions = {}
+
+
+def connection_options():
+    # Pool size and timeouts come from the environment (.env), see .env.example
+    options = {
+        "maxPoolSize": int(os.getenv('MONGO_MAX_POOL_SIZE', 100)),
+        "minPoolSize": int(os.getenv('MONGO_MIN_POOL_SIZE', 0)),
+        "serverSelectionTimeoutMS": int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+        "connectTimeoutMS": int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', 5000)),
+        "socketTimeoutMS": int(os.getenv('MONGO_SOCKET_TIMEOUT_MS', 10000)),
+    }
+    write_concern = os.getenv('MONGO_WRITE_CONCERN')
+    if write_concern:
+        options["w"] = int(write_concern) if write_concern.isdigit() else write_concern
+    read_preference = os.getenv('MONGO_READ_PREFERENCE')
+    if read_preference:
+        options["readPreference"] = read_preference
+    return options
+
+
+class CommandMetrics(monitoring.CommandListener):
+    # pymongo publishes these on the thread that sent the command
+    def started(self, event):
+        metrics.count_round_trip()
+
+    def succeeded(self, event):
+        metrics.mongo_commands.observe(event.duration_micros / 1e6, event.command_name, "succeeded")
+
+    def failed(self, event):
+        metrics.mongo_commands.observe(event.duration_micros / 1e6, event.command_name, "failed")
+
+
+def get_connection():
+    # Created on first use, importing this module does not touch the database
+    mongo_connection_string = os.getenv('MONGO_CONNECTION_STRING')
+    connection = connections.get(mongo_connection_string)
+    if connection is not None and mongo_connection_string in indexed:
+        return connection
+    with connection_lock:
+        if mongo_connection_string not in connections:
+            connections[mongo_connection_string] = PyMongoClient(
+                mongo_connection_string, event_listeners=[CommandMetrics()], **connection_options()
+            )
+        connection = connections[mongo_connection_string]
+        if mongo_connection_string not in indexed:
+            db = connection.liar_decks
+            adopt_single_room_documents(db)
+            db.game_data.create_index([("room_id", ASCENDING), ("key", ASCENDING)], unique=True)
+            db.players.create_index([("room_id", ASCENDING), ("player_id", ASCENDING)], unique=True)
+            db.game_log.create_index([("room_id", ASCENDING), ("seq", ASCENDING)], unique=True)
+            indexed.add(mongo_connection_string)
+    return connection
+
+
+def check_health():
+    # One round trip to the server
+    try:
+        get_connection().admin.command("ping")
+    except PyMongoError as e:
+        raise StorageUnavailable(str(e))
+
+
+def forget_connections():
+    # pymongo clients are not fork-safe, a forked worker process opens its own
+    global connection_lock
+    connection_lock = threading.Lock()
+    connections.clear()
+    transactions.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=forget_connections)
+
+
+def adopt_single_room_documents(db):
+    # Documents written before rooms existed used the key as _id, file them under "default"
+    for doc in db.game_data.find({"room_id": {"$exists": False}}, {"_id": 1}):
+        db.game_data.update_one({"_id": doc["_id"]}, {"$set": {"room_id": "default", "key": doc["_id"]}})
+    for doc in db.players.find({"room_id": {"$exists": False}}, {"_id": 1}):
+        db.players.update_one({"_id": doc["_id"]}, {"$set": {"room_id": "default", "player_id": doc["_id"]}})
+
+
+def supports_transactions(connection):
+    # Replica sets and sharded clusters do, a standalone mongod does not
+    if id(connection) not in transactions:
+        try:
+            hello = connection.admin.command("hello")
+            transactions[id(connection)] = "setName" in hello or hello.get("msg") == "isdbgrid"
+        except PyMongoError:
+            transactions[id(connection)] = False
+    return transactions[id(connection)]
+
+
+def append_log_history(db, room_id, last_seq, entries, session=None):
+    # Upserts on (room_id, seq), so writing the same entries twice is harmless
+    first_seq = last_seq - len(entries) + 1
+    db.game_log.bulk_write([
+        UpdateOne({"room_id": room_id, "seq": first_seq + i}, {"$setOnInsert": {"message": message}}, upsert=True)
+        for i, message in enumerate(entries)
+    ], ordered=False, session=session)
+
+
+def get_log_page(db, room_id, after, limit):
+    cursor = db.game_log.find(
+        {"room_id": room_id, "seq": {"$gt": after}},
+        {"_id": 0, "seq": 1, "message": 1}
+    ).sort("seq", ASCENDING).limit(limit)
+    return list(cursor)
+
+
+# A write whose outcome is unknown (connection dropped mid-request) is sent
+# once more, the move id stored with the version makes the second one a no-op
+MAX_WRITE_ATTEMPTS = 2
+
+# Every key the split layout keeps in game_data for one room
+GAME_DATA_KEYS = (
+    "game_state", "card_pile", "reference_card", "log", "log_count", "current_turn_index",
+    "game_winner", "last_play", "player_order", "assigned_players", "version"
+)
+# Move fields saved as game_data keys, game_started is stored as game_state
+STORED_KEYS = {
+    "game_started": "game_state", "card_pile": "card_pile", "current_turn_index": "current_turn_index",
+    "player_order": "player_order", "reference_card": "reference_card", "game_winner": "game_winner",
+    "log": "log", "log_count": "log_count", "assigned_players": "assigned_players", "last_play": "last_play"
+}
+PLAYER_FIELDS = ("hand", "roulette_index", "roulette", "key", "is_eliminated")
+
+
+class MongoStore(GameStore):
+    """What both Mongo layouts share; subclasses write a move with write_changes()."""
+
+    @property
+    def mongo_client(self):
+        return get_connection()
+
+    def ping(self):
+        check_health()
+
+    def save_game(self, changes, expected_version, move_id=None):
+        for attempt in range(MAX_WRITE_ATTEMPTS):
+            try:
+                return self.write_changes(changes, expected_version, move_id)
+            except AutoReconnect:
+                if move_id is None or attempt == MAX_WRITE_ATTEMPTS - 1:
+                    raise
+
+    def write_changes(self, changes, expected_version, move_id):
+        raise NotImplementedError
+
+
+class MongoClient(MongoStore):
+    def __init__(self, room_id="default"):
+        self.room_id = room_id
+
+    def data_filter(self, key):
+        return {"room_id": self.room_id, "key": key}
+
+    def player_filter(self, player_id):
+        return {"room_id": self.room_id, "player_id": player_id}
+
+    def clean_player_doc(self, player_doc):
+        for field in ("_id", "room_id", "player_id"):
+            player_doc.pop(field, None)
+        return player_doc
+
+    def get_log_page(self, after, limit):
+        return get_log_page(self.mongo_client.liar_decks, self.room_id, after, limit)
+
+    def get_players_data(self):
+        # All players of the room in one query
+        players = {}
+        for player_doc in self.mongo_client.liar_decks.players.find({"room_id": self.room_id},
+                                                                    {"_id": 0, "room_id": 0}):
+            player_id = player_doc["player_id"]
+            players[player_id] = self.clean_player_doc(player_doc)
+        return players
+
+    def get_version(self):
+        # Polled by every cached game, only the value is needed
+        doc = self.mongo_client.liar_decks.game_data.find_one(self.data_filter("version"), {"_id": 0, "value": 1})
+        if doc and doc.get("value") is not None:
+            return int(doc["value"])
         return None
 
-    def set_log(self, log):
-        self.mongo_client.liar_decks.game_data.update_one(
-            {"_id": "log"},
-            {"$set": {"value": log}},
-            upsert=True
+    def get_game_data(self, keys):
+        # Several game_data keys in one round trip, missing ones are left out
+        cursor = self.mongo_client.liar_decks.game_data.find(
+            {"room_id": self.room_id, "key": {"$in": list(keys)}},
+            {"_id": 0, "key": 1, "value": 1}
         )
+        return {doc["key"]: doc.get("value") for doc in cursor}
 
-    def get_log(self):
-        doc = self.mongo_client.liar_decks.game_data.find_one({"_id": "log"})
-        if doc:
-            return doc["value"]
-        return None
-
-    def set_current_turn_index(self, index):
-        self.mongo_client.liar_decks.game_data.update_one(
-            {"_id": "current_turn_index"},
-            {"$set": {"value": index}},
-            upsert=True
-        )
-
-    def get_current_turn_index(self):
-        doc = self.mongo_client.liar_decks.game_data.find_one({"_id": "current_turn_index"})
-        if doc:
-            return int(doc["value"])
-        return None
-
-    def insert_player_data(self, player_id, player_data):
-        player_data_mapping = {
-            "hand": player_data["hand"],
-            "roulette_index": player_data["roulette_index"],
-            "roulette": player_data["roulette"],
-            "key": player_data["key"],
-            "is_eliminated": player_data["is_eliminated"]
+    def reset_database(self):
+        # Drops every room, the indexes are rebuilt on the next connection
+        self.mongo_client.liar_decks.game_data.drop()
+        self.mongo_client.liar_decks.players.drop()
+        self.mongo_client.liar_decks.game_log.drop()
+        indexed.clear()
+        get_connection()
+
+    def load_game(self):
+        # Two round trips: every game_data key, then every player of the room
+        data = self.get_game_data(GAME_DATA_KEYS)
+        player_order = data.get("player_order") or []
+        assigned_players = data.get("assigned_players") or []
+        stored_players = self.get_players_data()
+
+        player_ids = player_order or ["player1", "player2", "player3", "player4"]
+        players = {p: stored_players[p] for p in player_ids if p in stored_players}
+        last_play = data.get("last_play") or {"player_id": None, "cards": []}
+        return {
+            "players": players,
+            "game_started": True if data.get("game_state") else False,
+            "card_pile": data.get("card_pile") or [],
+            "current_turn_index": int(data.get("current_turn_index") or 0),
+            "player_order": player_order,
+            "reference_card": data.get("reference_card"),
+            "last_play": last_play,
+            "game_winner": data.get("game_winner"),
+            "log": data.get("log") or [],
+            "log_count": int(data.get("log_count") or 0),
+            "assigned_players": assigned_players,
+            "player_keys": {p: stored_players.get(p, {}).get("key") for p in assigned_players},
+            "version": int(data.get("version") or 0)
         }
 
-        self.mongo_client.liar_decks.players.update_one(
-            {"_id": player_id},
-            {"$set": player_data_mapping},
+    def write_changes(self, changes, expected_version, move_id):
+        db = self.mongo_client.liar_decks
+        version = expected_version + 1
+        data_ops, player_ops = self.change_operations(changes, version, move_id)
+
+        def write(session=None):
+            doc = db.game_data.find_one(self.data_filter("version"), {"_id": 0, "value": 1, "move_id": 1},
+                                        session=session)
+            current = int(doc.get("value") or 0) if doc else 0
+            if move_id is not None and doc and doc.get("move_id") == move_id:
+                return current  # Already applied by an earlier attempt
+            if current != expected_version:
+                raise VersionConflict(f"expected version {expected_version}")
+
+            if player_ops:
+                db.players.bulk_write(player_ops, ordered=False, session=session)
+            if "log_entries" in changes:
+                append_log_history(db, self.room_id, changes["log_count"], changes["log_entries"], session)
+            # Ordered, so the version that tells readers to reload lands last
+            db.game_data.bulk_write(data_ops, session=session)
+            return version
+
+        if not supports_transactions(self.mongo_client):
+            # Without transactions the version check only narrows the window
+            # in which two writers can interleave
+            return write()
+        with self.mongo_client.start_session() as session:
+            return session.with_transaction(write)
+
+    def change_operations(self, changes, version, move_id):
+        # One bulk write per collection instead of a round trip per field
+        data_ops = []
+        for field, value in changes.items():
+            key = STORED_KEYS.get(field)
+            if key is not None:
+                data_ops.append(UpdateOne(self.data_filter(key), {"$set": {"value": value}}, upsert=True))
+        if "log_entries" in changes and "log" not in changes:
+            data_ops.append(UpdateOne(
+                self.data_filter("log"),
+                {"$push": {"value": {"$each": changes["log_entries"], "$slice": -LOG_TAIL}}},
+                upsert=True
+            ))
+        data_ops.append(UpdateOne(
+            self.data_filter("version"),
+            {"$set": {"value": version, "move_id": move_id}},
             upsert=True
-        )
-
-    def get_player_data(self, player_id):
-        try:
-            player_doc = self.mongo_client.liar_decks.players.find_one({"_id": player_id})
+        ))
 
-            if not player_doc:
-                return None
+        player_ops = []
+        for player_id, key in changes.get("player_keys", {}).items():
+            player_ops.append(UpdateOne(self.player_filter(player_id), {"$set": {"key": key}}, upsert=True))
+        for player_id, player_data in changes.get("players", {}).items():
+            fields = {field: player_data[field] for field in PLAYER_FIELDS}
+            player_ops.append(UpdateOne(self.player_filter(player_id), {"$set": fields}, upsert=True))
+        return data_ops, player_ops
 
-            # Remove the _id field from the returned document
-            if "_id" in player_doc:
-                del player_doc["_id"]
-
-            return player_doc
-        except Exception as e:
-            print(f"Error retrieving player data for {player_id}: {e}")
-            return None
 
-    def get_all_players_data(self):
-        all_players_data = {}
-        player_ids = self.get_player_order() or ["player1", "player2", "player3", "player4"]
-
-        try:
-            for player_id in player_ids:
-                player_doc = self.mongo_client.liar_decks.players.find_one({"_id": player_id})
-                if player_doc:
-                    player_data = player_doc.copy()
-                    if "_id" in player_data:
-                        del player_data["_id"]
-                    all_players_data[player_id] = player_data
-
-            return all_players_data
-        except Exception as e:
-            print(f"Error retrieving all players data: {e}")
-            return {}
-
-    def set_game_winner(self, player_id):
-        self.mongo_client.liar_decks.game_data.update_one(
-            {"_id": "game_winner"},
-            {"$set": {"value": player_id}},
-            upsert=True
-        )
+class MongoDocumentClient(MongoStore):
+    """Keeps a whole game in one liar_decks.games document keyed by room id.
 
-    def get_game_winner(self):
-        doc = self.mongo_client.liar_decks.game_data.find_one({"_id": "game_winner"})
-        if doc:
-            return doc["value"]
-        return None
+    Every move is a single find_one_and_update guarded by the version field,
+    so readers never see a half-applied move and concurrent writers lose
+    with VersionConflict instead of interleaving.
+    """
 
-    def set_last_play(self, player_id, cards):
-        last_play = {
-            "player_id": player_id,
-            "cards": cards
-        }
-        self.mongo_client.liar_decks.game_data.update_one(
-            {"_id": "last_play"},
-            {"$set": {"value": last_play}},
-            upsert=True
-        )
+    def __init__(self, room_id="default"):
+        self.game_id = room_id
 
-    def get_last_play(self):
-        doc = self.mongo_client.liar_decks.game_data.find_one({"_id": "last_play"})
-        if doc:
-            return doc["value"]
-        return {"player_id": None, "cards": []}
+    @property
+    def games(self):
+        return self.mongo_client.liar_decks.games
 
-    def set_player_order(self, player_order):
-        self.mongo_client.liar_decks.game_data.update_one(
-            {"_id": "player_order"},
-            {"$set": {"value": player_order}},
-            upsert=True
-        )
+    def load_game(self):
+        doc = self.games.find_one({"_id": self.game_id})
+        if not doc:
+            return None
+        del doc["_id"]
+        return doc
 
-    def get_player_order(self):
-        doc = self.mongo_client.liar_decks.game_data.find_one({"_id": "player_order"})
+    def get_version(self):
+        doc = self.games.find_one({"_id": self.game_id}, {"version": 1})
         if doc:
-            return doc["value"]
+            return doc.get("version")
         return None
 
-    def set_assigned_players(self, players):
-        self.mongo_client.liar_decks.game_data.update_one(
-            {"_id": "assigned_players"},
-            {"$set": {"value": players}},
-            upsert=True
-        )
-
-    def get_assigned_players(self):
-        doc = self.mongo_client.liar_decks.game_data.find_one({"_id": "assigned_players"})
-        return doc['value'] if doc else []
-
-    def set_roulette_index(self, player_id, index):
-        self.mongo_client.liar_decks.players.update_one(
-            {"_id": player_id},
-            {"$set": {"roulette_index": index}}
-        )
-
-    def set_player_killed(self, player_id):
-        self.mongo_client.liar_decks.players.update_one(
-            {"_id": player_id},
-            {"$set": {"is_eliminated": True}}
-        )
-
-    def update_player_hand(self, player_id, hand):
-        self.mongo_client.liar_decks.players.update_one(
-            {"_id": player_id},
-            {"$set": {"hand": hand}}
-        )
+    def write_changes(self, changes, expected_version, move_id):
+        version = expected_version + 1
+        fields = dict(changes)
+        log_entries = fields.pop("log_entries", None)
+        fields["version"] = version
+        fields["move_id"] = move_id
+        update = {"$set": fields}
+        if log_entries and "log" not in fields:
+            update["$push"] = {"log": {"$each": log_entries, "$slice": -LOG_TAIL}}
+        try:
+            doc = self.games.find_one_and_update(
+                {"_id": self.game_id, "version": expected_version},
+                update,
+                projection={"version": 1},
+                upsert=expected_version == 0,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The upsert raced with a writer that created the game first
+            doc = None
+        if not doc:
+            doc = self.games.find_one({"_id": self.game_id}, {"version": 1, "move_id": 1})
+            if move_id is None or not doc or doc.get("move_id") != move_id:
+                raise VersionConflict(f"expected version {expected_version}")
+            # An earlier attempt got through, only the log history may be missing
+            version = doc["version"]
+        if log_entries:
+            append_log_history(self.mongo_client.liar_decks, self.game_id, changes["log_count"], log_entries)
+        return version
+
+    def get_log_page(self, after, limit):
+        return get_log_page(self.mongo_client.liar_decks, self.game_id, after, limit)
+
+    def replace_game(self, game):
+        self.games.replace_one({"_id": self.game_id}, game, upsert=True)
 
     def reset_database(self):
-        self.mongo_client.liar_decks.game_data.drop()
-        self.mongo_client.liar_decks.players.drop()
-
-    def reset_new_game_state(self):
-        self.mongo_client.liar_decks.game_data.update_many(
-            {},
-            {"$set": {"value": None}}
-        )
-        # Update players collection instead of dropping it
-        player_ids = self.get_player_order() or []
-        for player_id in player_ids:
-            player_key = self.get_player_key(player_id)
-            if player_key:
-                self.mongo_client.liar_decks.players.update_one(
-                    {"_id": player_id},
-                    {"$set": {
-                        "hand": [],
-                        "roulette_index": 0,
-                        "roulette": [],
-                        "is_eliminated": False
-                    }, "$setOnInsert": {"key": player_key}},
-                    upsert=True
-                )
-
-    def set_player_key(self, player_id, key):
-        self.mongo_client.liar_decks.players.update_one(
-            {"_id": player_id},
-            {"$set": {"key": key}},
-            upsert=True
-        )
-
-    def get_player_key(self, player_id):
-        doc = self.mongo_client.liar_decks.players.find_one({"_id": player_id})
-        if doc and "key" in doc:
-            return doc["key"]
-        return None
\ No newline at end of file
+        self.games.drop()
+        self.mongo_client.liar_decks.game_log.drop()
+        indexed.clear()
+        get_connection()
+
+
+def create_client(room_id="default"):
+    # GAME_STORAGE_LAYOUT=document stores each game as one document
+    if os.getenv('GAME_STORAGE_LAYOUT', 'legacy') == 'document':
+        return MongoDocumentClient(room_id)
+    return MongoClient(room_id)
+
+
+def migrate_legacy_layout():
+    migrated = []
+    room_ids = get_connection().liar_decks.game_data.distinct("room_id")
+    for room_id in room_ids:
+        game = MongoClient(room_id).load_game()
+        MongoDocumentClient(room_id).replace_game(game)
+        migrated.append(room_id)
+    return migrated
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Liar's Deck database maintenance")
+    parser.add_argument('action', nargs='?', choices=['migrate', 'reset'], default='migrate',
+                        help="migrate: copy the split layout into liar_decks.games, reset: delete every game")
+    args = parser.parse_args()
+    if args.action == 'reset':
+        create_client().reset_database()
+        print("Database reset")
+    else:
+        rooms = migrate_legacy_layout()
+        print(f"Migrated {len(rooms)} room(s) to liar_decks.games")
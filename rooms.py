@@ -0,0 +1,71 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from game_logic import LiarDeckGame
+
+DEFAULT_ROOM = "default"
+ROOM_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+# Rooms untouched for this many seconds are dropped from memory. Their state
+# is already persisted, so the next request simply reloads it.
+ROOM_IDLE_TIMEOUT = 600
+MAX_ROOMS_IN_MEMORY = 10000
+EVICT_INTERVAL = 30
+
+
+class RoomRegistry:
+    def __init__(self, idle_timeout=ROOM_IDLE_TIMEOUT, max_rooms=MAX_ROOMS_IN_MEMORY):
+        self.idle_timeout = idle_timeout
+        self.max_rooms = max_rooms
+        # Least recently used room first
+        self.rooms = OrderedDict()
+        self.last_access = {}
+        self.lock = threading.Lock()
+        self.last_eviction = time.monotonic()
+
+    def is_valid_room_id(self, room_id):
+        return isinstance(room_id, str) and ROOM_ID_PATTERN.match(room_id) is not None
+
+    def get(self, room_id=DEFAULT_ROOM):
+        with self.lock:
+            game = self.rooms.get(room_id)
+            if game is not None:
+                self.touch(room_id)
+                return game
+
+        # Load outside the lock so a slow load does not stall other rooms
+        loaded = LiarDeckGame(room_id)
+
+        with self.lock:
+            game = self.rooms.setdefault(room_id, loaded)
+            self.touch(room_id)
+            now = time.monotonic()
+            if len(self.rooms) > self.max_rooms or now - self.last_eviction >= EVICT_INTERVAL:
+                self.evict_idle(now)
+            return game
+
+    def touch(self, room_id):
+        self.rooms.move_to_end(room_id)
+        self.last_access[room_id] = time.monotonic()
+
+    def evict_idle(self, now=None):
+        # Caller holds self.lock
+        now = now or time.monotonic()
+        self.last_eviction = now
+        cutoff = now - self.idle_timeout
+        while self.rooms:
+            room_id = next(iter(self.rooms))
+            if self.last_access[room_id] >= cutoff and len(self.rooms) <= self.max_rooms:
+                break
+            del self.rooms[room_id]
+            del self.last_access[room_id]
+
+    def clear(self):
+        # Also used after fork, so the lock is replaced rather than acquired
+        self.lock = threading.Lock()
+        self.rooms = OrderedDict()
+        self.last_access = {}
+
+    def __len__(self):
+        return len(self.rooms)
@@ -0,0 +1,244 @@
+"""Liar's Deck rules as plain state transitions: no storage, locks or HTTP.
+
+LiarDeckGame adds persistence and the lobby on top; simulator.py plays
+the same rules offline.
+"""
+import logging
+import random
+
+# Hands and the pile are stored as a count per rank, in this order
+RANKS = ["Ace", "Jack", "Queen", "King"]
+RANK_INDEX = {rank: i for i, rank in enumerate(RANKS)}
+CARDS_PER_RANK = 6
+
+
+def count_cards(cards):
+    """Rank counts for a list of card names. Counts pass through, so older
+    documents that stored the names load the same way. Unknown names raise KeyError."""
+    if len(cards) == len(RANKS) and all(isinstance(card, int) for card in cards):
+        return list(cards)
+    counts = [0] * len(RANKS)
+    for card in cards:
+        counts[RANK_INDEX[card]] += 1
+    return counts
+
+
+def expand_cards(counts):
+    return [rank for rank, count in zip(RANKS, counts) for _ in range(count)]
+
+
+class LiarDeckRules:
+    """One table's state and every move that changes it.
+
+    Moves return the same {"status": ...} dicts the HTTP API sends back.
+    Randomness comes from rng (the random module unless given), so a
+    seeded random.Random replays a game exactly.
+    """
+
+    def __init__(self, rng=None):
+        self.rng = rng or random
+        self.players = {}
+        self.game_started = False
+        self.card_pile = [0] * len(RANKS)
+        self.current_turn_index = 0
+        self.player_order = []
+        self.reference_card = None
+        self.last_play = {"player_id": None, "cards": []}
+        self.game_winner = None
+        self.log = []
+        self.log_count = 0
+        self.log_cleared = False
+
+    def start_round(self, player_ids, player_keys=None):
+        # Fresh round, player_keys only rides along in the player documents
+        self.players = {}
+        self.game_started = False
+        self.card_pile = [0] * len(RANKS)
+        self.current_turn_index = 0
+        self.reference_card = None
+        self.last_play = {"player_id": None, "cards": []}
+        self.game_winner = None
+
+        self.player_order = list(player_ids)
+
+        if len(self.player_order) < 2:
+            self.clear_log()
+            self.add_to_log("Waiting for more players to join...")
+            return {"status": "ERROR", "message": "Need at least 2 players to start."}
+
+        deck = self.shuffle_deck()
+
+        num_players = len(self.player_order)
+        cards_per_player = len(deck) // num_players
+
+        for i, player_id in enumerate(self.player_order):
+            logging.debug(f"Assigning player {player_id}")
+            self.players[player_id] = {
+                "hand": count_cards(deck[i * cards_per_player: (i + 1) * cards_per_player]),
+                "roulette_index": 0,
+                "roulette": self.rng.randint(0, 2),
+                "key": (player_keys or {}).get(player_id),
+                "is_eliminated": False
+            }
+
+        self.game_started = True
+        self.current_turn_index = 0
+
+        self.clear_log()  # Reset log for new game
+        self.add_to_log(f"Game started with {num_players} players.")
+        self.add_to_log(f"Reference card is {self.reference_card}.")
+        self.add_to_log(f"It's {self.player_order[self.current_turn_index]}'s turn.")
+
+        return {"status": "OK", "message": "Game started successfully."}
+
+    def generate_new_deck(self):
+        deck = self.shuffle_deck()
+
+        active_players = [p for p in self.player_order if not self.players.get(p, {}).get("is_eliminated")]
+        num_active_players = len(active_players)
+        if num_active_players == 0: return
+
+        cards_per_player = len(deck) // num_active_players
+
+        for i, player_id in enumerate(active_players):
+            self.players[player_id]["hand"] = count_cards(deck[i * cards_per_player: (i + 1) * cards_per_player])
+
+    def shuffle_deck(self):
+        deck = [rank for rank in RANKS for _ in range(CARDS_PER_RANK)]
+        self.rng.shuffle(deck)
+        self.reference_card = self.rng.choice(RANKS)
+        return deck
+
+    def next_turn(self, set_turn_to_player=None):
+        active_players = [p for p in self.player_order if not self.players.get(p, {}).get("is_eliminated")]
+
+        if not active_players or len(active_players) <= 1:
+            self.game_winner = active_players[0] if active_players else "No one"
+            self.add_to_log(f"Game over! Winner is {self.game_winner}")
+            return
+
+        all_hands_empty = all(sum(self.players[p]["hand"]) == 0 for p in active_players)
+        if all_hands_empty:
+            self.generate_new_deck()
+            self.add_to_log("All players have no cards left. New deck generated.")
+
+        if set_turn_to_player and not self.players.get(set_turn_to_player, {}).get("is_eliminated"):
+            self.current_turn_index = self.player_order.index(set_turn_to_player)
+        else:
+            current_player_id = self.player_order[self.current_turn_index]
+
+            next_index = (self.player_order.index(current_player_id) + 1) % len(self.player_order)
+
+            while self.players.get(self.player_order[next_index], {}).get("is_eliminated"):
+                next_index = (next_index + 1) % len(self.player_order)
+            self.current_turn_index = next_index
+
+        if sum(self.players[self.player_order[self.current_turn_index]]["hand"]) == 0:
+            logging.debug("Setting game winner due to no cards left.")
+            winner = self.player_order[self.current_turn_index]
+            self.set_game_winner(winner)
+            return {"status": "OK", "message": f"No cards left to play. {winner} is the winner!"}
+
+        self.add_to_log(f"It's {self.player_order[self.current_turn_index]}'s turn.")
+
+    def play_cards(self, player_id, cards_played):
+        if self.player_order[self.current_turn_index] != player_id:
+            return {"status": "ERROR", "message": "Not your turn."}
+
+        for player in self.player_order:
+            if (player in self.players and sum(self.players[player]["hand"]) == 0 and
+                    not self.players[player].get("is_eliminated", False)):
+                self.set_game_winner(player)
+                return {"status": "OK", "message": f"{player} has no cards left. Game over!"}
+
+        player_hand = self.players.get(player_id, {}).get("hand", [0] * len(RANKS))
+
+        # Verify cards are in hand before removing, one comparison per rank
+        if not isinstance(cards_played, list):
+            return {"status": "ERROR", "message": "Cards must be a list of card names."}
+        for card in cards_played:
+            if not isinstance(card, str) or card not in RANK_INDEX:
+                return {"status": "ERROR", "message": f"You don't have a {card}."}
+        played = count_cards(cards_played)
+        for rank, count in enumerate(played):
+            if count > player_hand[rank]:
+                return {"status": "ERROR", "message": f"You don't have a {RANKS[rank]}."}
+
+        # If verification passes, update hand
+        self.players[player_id]["hand"] = [have - count for have, count in zip(player_hand, played)]
+        self.card_pile = [pile + count for pile, count in zip(self.card_pile, played)]
+
+        self.last_play = {"player_id": player_id, "cards": cards_played}
+
+        self.add_to_log(f"{player_id} played {len(cards_played)} card(s).")
+        self.next_turn()
+        return {"status": "OK"}
+
+    def set_game_winner(self, player_id):
+        if player_id not in self.players or self.players[player_id]["is_eliminated"]:
+            return {"status": "ERROR", "message": "Player not found or already eliminated."}
+
+        self.game_winner = player_id
+        logging.debug(f"Game winner set to: {self.game_winner}")
+        self.add_to_log(f"Game over! Winner is {self.game_winner}")
+
+    def kill_player(self, player_id):
+        if player_id not in self.players or self.players[player_id]["is_eliminated"]:
+            return {"status": "ERROR", "message": "Player not found or already eliminated."}
+
+        self.players[player_id]["is_eliminated"] = True
+        self.add_to_log(f"{player_id} has been eliminated.")
+
+        # Check for winner
+        active_players = [p for p in self.player_order if not self.players.get(p, {}).get("is_eliminated")]
+        if len(active_players) == 1:
+            self.game_winner = active_players[0]
+            self.add_to_log(f"Game over! Winner is {self.game_winner}")
+
+    def proceed_roulette(self, player_id):
+        player_data = self.players.get(player_id)
+        if not player_data: return
+
+        roulette_index = player_data["roulette_index"]
+        bullet_position = player_data["roulette"]
+
+        if roulette_index == bullet_position:
+            self.add_to_log(f"{player_id} pulls the trigger... BANG!")
+            self.kill_player(player_id)
+        else:
+            player_data["roulette_index"] += 1
+            self.add_to_log(f"{player_id} survived the roulette! Index is now {player_data['roulette_index']}.")
+
+    def resolve_challenge(self, challenger_id):
+        if not self.last_play or not self.last_play["player_id"]:
+            return {"status": "ERROR", "message": "No play to challenge."}
+
+        player_who_played = self.last_play["player_id"]
+        cards_in_play = self.last_play["cards"]
+
+        is_a_lie = count_cards(cards_in_play)[RANK_INDEX[self.reference_card]] != len(cards_in_play)
+
+        if is_a_lie:
+            winner, loser = challenger_id, player_who_played
+            self.add_to_log(f"{challenger_id} challenges {player_who_played}... and was RIGHT!")
+            self.proceed_roulette(loser)
+        else:
+            winner, loser = player_who_played, challenger_id
+            self.add_to_log(f"{challenger_id} challenges {player_who_played}... and was WRONG!")
+            self.proceed_roulette(loser)
+
+        self.card_pile = [0] * len(RANKS)
+        self.last_play = {"player_id": None, "cards": []}  # Clear last play after challenge
+
+        self.generate_new_deck()
+        self.next_turn(set_turn_to_player=winner)
+        return {"status": "OK", "challenge_winner": winner, "challenge_loser": loser}
+
+    def add_to_log(self, message):
+        self.log_count += 1
+        self.log.append(message)
+
+    def clear_log(self):
+        # Only the inline tail is cleared, the stored history keeps every entry
+        self.log = []
+        self.log_cleared = True
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import threading
+import metrics
+from admission import MAX_QUEUE_WAIT
+from concurrent.futures import ThreadPoolExecutor
+from http import HttpServer, StateSubscription, RequestParser, RequestError
+from http import KEEP_ALIVE_TIMEOUT, MAX_KEEP_ALIVE_REQUESTS
+
+httpserver = HttpServer()
+
+
+class AsyncServer(threading.Thread):
+    """Event-loop worker, a drop-in for server_thread_http.Server.
+
+    Sockets are handled as coroutines on one loop; HttpServer.proses still
+    blocks on Mongo, so it runs on a small thread pool instead of the loop.
+    """
+
+    def __init__(self, ipaddr='0.0.0.0', port=8889, backlog=128, max_connections=1000, worker_threads=16,
+                 reuse_port=False, queue_depth=256):
+        self.ipinfo = (ipaddr, port)
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+        self.max_connections = max_connections
+        self.queue_depth = queue_depth
+        # Connections waiting for one of the max_connections slots
+        self.waiting = 0
+        self.executor = ThreadPoolExecutor(max_workers=worker_threads, thread_name_prefix=f"worker-{port}")
+        threading.Thread.__init__(self)
+
+    async def handle_client(self, reader, writer):
+        if not self.connection_slots.locked():
+            await self.connection_slots.acquire()
+        elif self.waiting >= self.queue_depth:
+            await self.shed(writer, "queue_full")
+            return
+        elif not await self.wait_for_slot():
+            await self.shed(writer, "queue_timeout")
+            return
+        try:
+            await self.serve_client(reader, writer)
+        finally:
+            self.connection_slots.release()
+
+    async def wait_for_slot(self):
+        self.waiting += 1
+        metrics.queued_connections.inc("async")
+        try:
+            await asyncio.wait_for(self.connection_slots.acquire(), MAX_QUEUE_WAIT)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting -= 1
+            metrics.queued_connections.dec("async")
+
+    async def shed(self, writer, reason):
+        metrics.shed.inc("async", reason)
+        try:
+            writer.write(httpserver.overloaded_response())
+            await writer.drain()
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve_client(self, reader, writer):
+        parser = RequestParser(client=(writer.get_extra_info('peername') or ('',))[0])
+        handled = 0
+        metrics.active_connections.inc("async")
+        try:
+            while True:
+                try:
+                    request = parser.next()
+                except RequestError as e:
+                    writer.write(httpserver.error_response(e))
+                    await writer.drain()
+                    break
+                if request is None:
+                    # Pipelined requests simply stay buffered in the parser
+                    try:
+                        data = await asyncio.wait_for(reader.read(65536), KEEP_ALIVE_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        break  # Idle keep-alive connection
+                    if not data:
+                        break
+                    parser.feed(data)
+                    continue
+
+                handled += 1
+                # Give the slot up after this response when other connections are waiting for one
+                keep_alive = request.keep_alive and handled < MAX_KEEP_ALIVE_REQUESTS and not self.waiting
+
+                loop = asyncio.get_running_loop()
+                hasil = await loop.run_in_executor(self.executor, httpserver.proses, request, keep_alive)
+
+                if isinstance(hasil, StateSubscription):
+                    # Waiting happens on the loop, only building the state takes an executor thread
+                    if hasil.stream:
+                        writer.write(hasil.stream_head())
+                        async for chunk in hasil.events_async(self.executor):
+                            if writer.is_closing():
+                                break
+                            writer.write(chunk)
+                            await writer.drain()
+                        break
+                    hasil = await hasil.respond_async(self.executor)
+
+                writer.write(hasil)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except Exception as e:
+            logging.error(f"Error processing client: {e}")
+        finally:
+            metrics.active_connections.dec("async")
+            writer.close()
+
+    async def serve(self):
+        # Connections past the limit wait here instead of spawning more work
+        self.connection_slots = asyncio.Semaphore(self.max_connections)
+        server = await asyncio.start_server(
+            self.handle_client, self.ipinfo[0], self.ipinfo[1],
+            backlog=self.backlog, reuse_address=True, reuse_port=self.reuse_port or None
+        )
+        logging.warning(f"Async server running on port {self.ipinfo[1]}")
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        asyncio.run(self.serve())
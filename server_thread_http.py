@@ -2,165 +2,855 @@ from socket import *
 import socket
 import threading
 import logging
-from http import HttpServer
+import argparse
+import multiprocessing
+import bisect
+import functools
+import hashlib
+import heapq
+import json
+import signal
+import time
+from http import HttpServer, StateSubscription, RequestParser, RequestError
+from http import KEEP_ALIVE_TIMEOUT, MAX_KEEP_ALIVE_REQUESTS, MAX_SUBSCRIBE_TIMEOUT, SSE_HEARTBEAT_INTERVAL, SSE_PING
+from game_logic import SYNC_INTERVAL
+from rooms import DEFAULT_ROOM
+from storage import create_store, storage_backend
+from log_setup import configure_logging
+from admission import ConnectionPool, Waiter
+import metrics
+from server_async_http import AsyncServer
 
 httpserver = HttpServer()
 
+# An idle keep-alive connection keeps its thread this long in case the next request follows
+# quickly, and is parked after that, or right away when no other thread is free
+IDLE_GRACE = 1
 
-class ProcessTheClient(threading.Thread):
-    def __init__(self, connection, address):
+
+def idle_grace(pool):
+    return 0 if pool.busy() else IDLE_GRACE
+
+
+def shed(connection, server, reason):
+    # Answered before the request is read, so only what already arrived is drained
+    metrics.shed.inc(server, reason)
+    try:
+        connection.setblocking(False)
+        try:
+            connection.recv(65536)
+        except OSError:
+            pass
+        # A 503 fits any send buffer, the timeout only guards against a peer that stopped reading
+        connection.settimeout(1)
+        connection.sendall(httpserver.overloaded_response())
+    except OSError:
+        pass
+    finally:
+        connection.close()
+
+
+def read_available(sock, size=65536, wait=0):
+    # One read waiting at most wait seconds: the bytes, b"" once the peer is gone, None when nothing arrived
+    timeout = sock.gettimeout()
+    sock.settimeout(wait)
+    try:
+        return sock.recv(size)
+    except (BlockingIOError, socket.timeout):
+        return None
+    except OSError:
+        return b""
+    finally:
+        sock.settimeout(timeout)
+
+
+class ProcessTheClient:
+    """One client connection of a worker, holding a pool thread only while a request is being answered.
+
+    Between requests, and while a /game/subscribe or /game/events request
+    waits for its game to change, the connection is parked on the waiter.
+    """
+
+    def __init__(self, connection, address, pool, waiter):
         self.connection = connection
         self.address = address
-        threading.Thread.__init__(self)
+        self.pool = pool
+        self.waiter = waiter
+        self.parser = RequestParser(client=address[0])
+        self.handled = 0
+        # The long-poll or event stream being waited on, and when the connection is due back regardless
+        self.subscription = None
+        self.deadline = None
+        self.watching = (connection,)
 
     def run(self):
+        self.connection.settimeout(KEEP_ALIVE_TIMEOUT)
+        metrics.active_connections.inc("thread")
+        self.serve()
+
+    def serve(self):
+        # Returns with the connection closed, or parked and owned by the waiter
         try:
-            all_headers = b""
             while True:
-                data = self.connection.recv(1024)
-                if not data:
-                    break
-                all_headers += data
-                if b"\r\n\r\n" in all_headers:
-                    header_part, body_part = all_headers.split(b"\r\n\r\n", 1)
+                try:
+                    request = self.parser.next()
+                except RequestError as e:
+                    self.connection.sendall(httpserver.error_response(e))
                     break
+                if request is None:
+                    data = read_available(self.connection, wait=idle_grace(self.pool))
+                    if data is None:
+                        self.park(KEEP_ALIVE_TIMEOUT)
+                        return
+                    if not data:
+                        break
+                    self.parser.feed(data)
+                    continue
+
+                self.handled += 1
+                keep_alive = request.keep_alive and self.handled < MAX_KEEP_ALIVE_REQUESTS
+
+                hasil = httpserver.proses(request, keep_alive)
+
+                if isinstance(hasil, StateSubscription):
+                    self.subscription = hasil
+                    if hasil.stream:
+                        self.connection.sendall(hasil.stream_head() + hasil.event())
+                        self.park(SSE_HEARTBEAT_INTERVAL)
+                    else:
+                        self.park(hasil.timeout)
+                    return
 
-            headers_str = header_part.decode('utf-8')
-            content_length = 0
-            for line in headers_str.split('\r\n'):
-                if line.lower().startswith('content-length:'):
-                    content_length = int(line.split(':')[1].strip())
+                self.connection.sendall(hasil)
+                if not keep_alive:
                     break
 
-            while len(body_part) < content_length:
-                data = self.connection.recv(1024)
-                if not data:
-                    break
-                body_part += data
-
-            full_request_str = headers_str + "\r\n\r\n" + body_part.decode('utf-8')
-
-            hasil = httpserver.proses(full_request_str)
-
-            self.connection.sendall(hasil)
+        except Exception as e:
+            logging.error(f"Error processing client: {e}")
+        self.close()
+
+    def resume(self, connection, address):
+        # Pool handler for a connection the waiter gave back
+        data = read_available(self.connection)
+        if data == b"":
+            self.close()
+            return
+        subscription = self.subscription
+        if subscription is None:
+            if data is None:
+                self.close()  # Idle for KEEP_ALIVE_TIMEOUT
+                return
+            self.parser.feed(data)
+            self.serve()
+            return
+        if data and not subscription.stream:
+            # Pipelined behind the long-poll, answered after it
+            self.parser.feed(data)
 
+        try:
+            # Also how moves made by other processes are noticed
+            subscription.game.sync_state()
+            changed = subscription.game.version != subscription.since
+            due = time.monotonic() >= self.deadline
+            if subscription.stream:
+                if changed or due:
+                    self.connection.sendall(subscription.event() if changed else SSE_PING)
+                    self.park(SSE_HEARTBEAT_INTERVAL)
+                else:
+                    self.waiter.park(self)
+                return
+            if not changed and not due:
+                self.waiter.park(self)
+                return
+            self.subscription = None
+            self.connection.sendall(subscription.render(subscription.game.version))
         except Exception as e:
             logging.error(f"Error processing client: {e}")
-        finally:
-            self.connection.close()
+            self.close()
+            return
+        if subscription.keep_alive:
+            self.serve()
+        else:
+            self.close()
+
+    def park(self, seconds):
+        self.deadline = time.monotonic() + seconds
+        self.waiter.park(self)
+
+    def overloaded(self, connection, reason):
+        # Pool shed callback, the waiter gave the connection back but no thread took it in time
+        if self.subscription is not None and self.subscription.stream:
+            # Already streaming, EventSource reconnects by itself
+            metrics.shed.inc("thread", reason)
+        else:
+            shed(connection, "thread", reason)
+        self.close()
+
+    def close(self):
+        metrics.active_connections.dec("thread")
+        self.connection.close()
+
+
+class SubscriptionWaiter(Waiter):
+    """The worker's waiter, which also gives subscribers back when their game changes.
+
+    A move in this process reports its game through the game's watchers,
+    and only that game's subscribers go back. Moves made by other processes
+    are noticed by sending one parked subscriber of each game back once per
+    SYNC_INTERVAL to run sync_state, so those storage calls stay off this thread.
+    """
+
+    def __init__(self, pool):
+        super().__init__(pool)
+        # Parked subscribers and the watcher registered by game, games moved since the last check,
+        # and (when, number, game) for the next check of each game by time
+        self.games = {}
+        self.watchers = {}
+        self.moved = set()
+        self.checks = []
+        self.next_check = {}
+
+    def game_moved(self, game, version):
+        # Called on the thread that made the move
+        with self.lock:
+            self.moved.add(game)
+        self.wake()
+
+    def add(self, client):
+        super().add(client)
+        if client.subscription is None:
+            return
+        game = client.subscription.game
+        if game not in self.games:
+            self.games[game] = set()
+            self.watchers[game] = functools.partial(self.game_moved, game)
+            game.watchers.append(self.watchers[game])
+            self.schedule_check(game, time.monotonic() + SYNC_INTERVAL)
+        self.games[game].add(client)
+        if game.version != client.subscription.since:
+            # Moved while the request was on its way here
+            with self.lock:
+                self.moved.add(game)
+
+    def remove(self, client):
+        if not super().remove(client):
+            return False
+        if client.subscription is not None:
+            game = client.subscription.game
+            self.games[game].discard(client)
+            if not self.games[game]:
+                del self.games[game]
+                del self.next_check[game]
+                game.watchers.remove(self.watchers.pop(game))
+        return True
+
+    def schedule_check(self, game, when):
+        self.next_check[game] = when
+        heapq.heappush(self.checks, (when, next(self.parks), game))
+
+    def check(self, now):
+        super().check(now)
+        with self.lock:
+            moved, self.moved = self.moved, set()
+        for game in moved:
+            for client in list(self.games.get(game, ())):
+                if client.subscription.since != game.version:
+                    self.hand_back(client)
+        while self.checks and self.checks[0][0] <= now:
+            when, _, game = heapq.heappop(self.checks)
+            if self.next_check.get(game) != when:
+                continue  # No subscribers left since, or checked on a newer schedule
+            self.hand_back(next(iter(self.games[game])))
+            if game in self.games:
+                self.schedule_check(game, now + SYNC_INTERVAL)
+
+    def next_timeout(self):
+        timeout = super().next_timeout()
+        while self.checks and self.next_check.get(self.checks[0][2]) != self.checks[0][0]:
+            heapq.heappop(self.checks)
+        if self.checks:
+            check = max(0.0, self.checks[0][0] - time.monotonic())
+            timeout = check if timeout is None else min(timeout, check)
+        return timeout
 
 
 class Server(threading.Thread):
-    def __init__(self, ipaddr='0.0.0.0', port=8889):
+    def __init__(self, ipaddr='0.0.0.0', port=8889, backlog=128, reuse_port=False, threads=128, queue_depth=256):
         self.ipinfo = (ipaddr, port)
-        self.the_clients = []
+        self.backlog = backlog
+        self.threads = threads
+        self.queue_depth = queue_depth
         self.my_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Several processes listen on the same port, the kernel spreads the accepts
+            self.my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         threading.Thread.__init__(self)
 
     def run(self):
-        self.my_socket.bind(self.ipinfo)
-        self.my_socket.listen(1)
-        logging.warning(f"Server running on port {self.ipinfo[1]}")
-        while True:
-            self.connection, self.client_address = self.my_socket.accept()
-            logging.warning(f"connection from {self.client_address}")
+        try:
+            self.my_socket.bind(self.ipinfo)
+            self.my_socket.listen(self.backlog)
+            logging.warning(f"Server running on port {self.ipinfo[1]}")
+            # Fixed number of client threads, a polling storm queues up and is then shed
+            self.pool = ConnectionPool(f"worker-{self.ipinfo[1]}", self.serve_client,
+                                       lambda connection, reason: shed(connection, "thread", reason),
+                                       self.threads, self.queue_depth)
+            # Connections with nothing to do wait here instead of on pool threads
+            self.waiter = SubscriptionWaiter(self.pool)
+            self.waiter.start()
+            while True:
+                try:
+                    connection, client_address = self.my_socket.accept()
+                except OSError as e:
+                    # Out of file descriptors and the like, keep accepting once some are freed
+                    logging.error(f"accept failed: {e}")
+                    time.sleep(0.1)
+                    continue
+                # Sampled, and formatted only when it is actually logged
+                logging.info("connection from %s", client_address, extra={"sampled": True})
+                if not self.pool.submit(connection, client_address):
+                    shed(connection, "thread", "queue_full")
+        finally:
+            # Free the port so a restarted worker can bind it again
+            self.my_socket.close()
+
+    def serve_client(self, connection, address):
+        ProcessTheClient(connection, address, self.pool, self.waiter).run()
+
+
+# Relay buffers are sized for whole responses instead of 1 KiB slices
+LB_BUFFER_SIZE = 65536
+HEALTH_CHECK_INTERVAL = 2
+HEALTH_CHECK_TIMEOUT = 1
+# Pooled upstream sockets are dropped before the worker's own idle timeout closes them
+UPSTREAM_IDLE_TIMEOUT = KEEP_ALIVE_TIMEOUT - 1
+# Long-polls may legitimately take up to MAX_SUBSCRIBE_TIMEOUT to answer
+UPSTREAM_READ_TIMEOUT = MAX_SUBSCRIBE_TIMEOUT + 5
+# Requests whose answer may be a long time coming, or an endless event stream
+SUBSCRIPTION_PATHS = ('/game/subscribe', '/game/events')
+
+
+class Upstream:
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.healthy = True
+        self.active = 0
+        # Moving average of response time in seconds, breaks least-connections ties
+        self.latency = 0.0
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self, pooled=True):
+        # Returns (socket, reused), a new connection unless pooled
+        now = time.monotonic()
+        with self.lock:
+            while pooled and self.idle:
+                sock, idle_since = self.idle.pop()
+                if now - idle_since < UPSTREAM_IDLE_TIMEOUT:
+                    return sock, True
+                sock.close()
+        sock = socket.create_connection(self.address, timeout=HEALTH_CHECK_TIMEOUT)
+        sock.settimeout(UPSTREAM_READ_TIMEOUT)
+        return sock, False
+
+    def release(self, sock):
+        with self.lock:
+            self.idle.append((sock, time.monotonic()))
+
+    def record_latency(self, seconds):
+        self.latency = 0.8 * self.latency + 0.2 * seconds
+
+    def check_health(self):
+        try:
+            with socket.create_connection(self.address, timeout=HEALTH_CHECK_TIMEOUT) as sock:
+                sock.settimeout(HEALTH_CHECK_TIMEOUT)
+                sock.sendall(b"GET /health HTTP/1.1\r\nConnection: close\r\n\r\n")
+                healthy = sock.recv(64).startswith(b"HTTP/1.1 200")
+        except OSError:
+            healthy = False
+        if healthy != self.healthy:
+            logging.warning(f"Worker on port {self.address[1]} is now {'up' if healthy else 'down'}")
+        self.healthy = healthy
+
+
+class HashRing:
+    """Consistent hash ring so a room keeps landing on the same worker.
+
+    Each worker owns many virtual points on the ring; while one is down, only
+    the rooms it owned move, to the next healthy worker clockwise.
+    """
+
+    def __init__(self, replicas=100):
+        self.replicas = replicas
+        self.points = []
+        self.owners = {}
+
+    def hash(self, key):
+        return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+    def add(self, node, name):
+        for i in range(self.replicas):
+            point = self.hash(f"{name}#{i}")
+            self.owners[point] = node
+            bisect.insort(self.points, point)
+
+    def get(self, key, accept=lambda node: True):
+        if not self.points:
+            return None
+        start = bisect.bisect(self.points, self.hash(key))
+        seen = set()
+        for offset in range(len(self.points)):
+            node = self.owners[self.points[(start + offset) % len(self.points)]]
+            if id(node) in seen:
+                continue
+            if accept(node):
+                return node
+            seen.add(id(node))
+        return None
+
+
+def room_for_request(request):
+    # Peek at the room a /game/* request belongs to, static files have none
+    if not request.path.startswith('/game/'):
+        return None
+    room_id = request.params.get('room_id')
+    if room_id is None and request.body:
+        try:
+            payload = json.loads(request.body)
+        except ValueError:
+            payload = None
+        if isinstance(payload, dict):
+            room_id = payload.get('room_id')
+    return room_id or DEFAULT_ROOM
 
-            clt = ProcessTheClient(self.connection, self.client_address)
-            clt.start()
-            self.the_clients.append(clt)
 
+def forwarded_for(raw, client):
+    # Appended as the last header, so the worker can tell it from one the client sent itself
+    header_end = raw.index(b"\r\n\r\n")
+    return raw[:header_end] + f"\r\nX-Forwarded-For: {client}".encode() + raw[header_end:]
 
-class LBServer(threading.Thread):
-    def __init__(self, ip='0.0.0.0', port=8181, worker_ports=[56000, 56001, 56002, 56003]):
-        self.ip = ip
-        self.port = port
-        self.worker_ports = worker_ports
-        self.current = 0
-        threading.Thread.__init__(self)
 
-    def run(self):
-        logging.warning(f"Load Balancer running on {self.ip}:{self.port}")
-        lb_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        lb_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        lb_socket.bind((self.ip, self.port))
-        lb_socket.listen(5)
-        while True:
-            conn, addr = lb_socket.accept()
-            logging.warning(f"Load Balancer connection from {addr}")
-            worker_port = self.worker_ports[self.current]
-            self.current = (self.current + 1) % len(self.worker_ports)
-            logging.warning(f"Forwarding to worker on port {worker_port}")
+def content_length(head):
+    for line in head.split(b"\r\n")[1:]:
+        if line.lower().startswith(b"content-length:"):
+            return int(line.split(b":")[1].strip())
+    return None
 
-            # Handle dalam thread terpisah untuk mencegah blocking
-            threading.Thread(target=self.forward_request, args=(conn, worker_port)).start()
 
-    def forward_request(self, conn, worker_port):
-        worker_sock = None
-        try:
-            worker_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            worker_sock.connect(('localhost', worker_port))
+def read_response_head(sock):
+    data = b""
+    while True:
+        header_end = data.find(b"\r\n\r\n")
+        if header_end != -1:
+            return data[:header_end + 4], data[header_end + 4:]
+        chunk = sock.recv(LB_BUFFER_SIZE)
+        if not chunk:
+            return None, b""
+        data += chunk
 
-            # Gunakan shared state untuk koordinasi thread
-            connection_active = {'active': True}
 
-            t1 = threading.Thread(target=self.pipe, args=(conn, worker_sock, connection_active))
-            t2 = threading.Thread(target=self.pipe, args=(worker_sock, conn, connection_active))
+class RelayClient:
+    """One client connection of the load balancer, relayed to the workers a request at a time.
 
-            t1.start()
-            t2.start()
+    Like ProcessTheClient it holds a pool thread only while there is work:
+    idle keep-alive connections, long-polls waiting for the worker's answer
+    and event streams between events are parked on the balancer's waiter.
+    """
 
-            t1.join()
-            t2.join()
+    def __init__(self, lb, connection, address):
+        self.lb = lb
+        self.connection = connection
+        self.address = address
+        self.parser = RequestParser()
+        # The exchange in progress: the worker, the socket to it and whether that came from its pool
+        self.upstream = None
+        self.sock = None
+        self.reused = False
+        self.keep_alive = False
+        self.started = None
+        self.streaming = False
+        self.watching = (connection,)
+        self.deadline = None
+
+    def run(self):
+        self.connection.settimeout(KEEP_ALIVE_TIMEOUT)
+        metrics.active_connections.inc("lb")
+        self.serve()
+
+    def serve(self):
+        # Returns with the connection closed, or parked and owned by the waiter
+        try:
+            while True:
+                try:
+                    request = self.parser.next()
+                except RequestError as e:
+                    self.connection.sendall(httpserver.error_response(e))
+                    break
+                if request is None:
+                    data = read_available(self.connection, LB_BUFFER_SIZE, idle_grace(self.lb.pool))
+                    if data is None:
+                        self.park((self.connection,), KEEP_ALIVE_TIMEOUT)
+                        return
+                    if not data:
+                        break
+                    self.parser.feed(data)
+                    continue
+
+                room_id = room_for_request(request)
+                self.upstream = self.lb.choose_upstream(room_id)
+                logging.info("Forwarding room %s to worker on port %s", room_id, self.upstream.address[1],
+                             extra={"sampled": True, "room_id": room_id, "upstream": self.upstream.address[1]})
+                self.keep_alive = request.keep_alive
+                self.started = time.monotonic()
+                raw = forwarded_for(request.raw, self.address[0])
+
+                if request.path in SUBSCRIPTION_PATHS:
+                    # The answer can take MAX_SUBSCRIBE_TIMEOUT or never end, so it is awaited parked.
+                    # On a new socket, a stale pooled one could not be retried without blocking.
+                    if not self.send(raw, pooled=False):
+                        break
+                    self.park((self.sock,), UPSTREAM_READ_TIMEOUT)
+                    return
 
+                head, rest = self.exchange(raw)
+                if head is None:
+                    break
+                if content_length(head) is None:
+                    self.start_stream(head, rest)
+                    return
+                if not self.respond(head, rest):
+                    break
         except Exception as e:
             logging.error(f"Forward error: {e}")
-        finally:
-            try:
-                if worker_sock:
-                    worker_sock.close()
-            except:
-                pass
-            try:
-                conn.close()
-            except:
-                pass
+        self.close()
 
-    def pipe(self, source, destination, connection_active):
+    def resume(self, connection, address):
+        # Pool handler for a connection the waiter gave back
         try:
-            while connection_active['active']:
-                data = source.recv(1024)
+            if self.streaming:
+                self.pump()
+                return
+            if self.sock is not None:
+                # The worker answered a long-poll or started a stream, or took too long
+                head, rest = None, b""
+                if time.monotonic() < self.deadline:
+                    head, rest = self.read_head()
+                if head is None:
+                    self.bad_gateway()
+                    self.close()
+                    return
+                if content_length(head) is None:
+                    self.start_stream(head, rest)
+                    return
+                if not self.respond(head, rest):
+                    self.close()
+                    return
+            else:
+                data = read_available(self.connection, LB_BUFFER_SIZE)
                 if not data:
-                    break
-                destination.sendall(data)
+                    self.close()  # Gone, or idle for KEEP_ALIVE_TIMEOUT
+                    return
+                self.parser.feed(data)
         except Exception as e:
-            logging.error(f"Pipe error: {e}")
-        finally:
-            # Tandai koneksi tidak aktif
-            connection_active['active'] = False
+            logging.error(f"Forward error: {e}")
+            self.close()
+            return
+        self.serve()
+
+    def send(self, request, pooled=True):
+        # False when the worker cannot be reached, the client has its 503 by then
+        try:
+            self.sock, self.reused = self.upstream.acquire(pooled)
+        except OSError:
+            self.upstream.healthy = False
+            self.finish()
+            self.connection.sendall(httpserver.response(503, 'Service Unavailable', {"error": "Worker unavailable"}))
+            return False
+        try:
+            self.sock.sendall(request)
+        except OSError:
+            pass  # Shows up as a missing response head
+        return True
+
+    def exchange(self, request):
+        # Response head and whatever followed it, or None once the client has its error response
+        while self.send(request):
+            head, rest = self.read_head()
+            if head is not None:
+                return head, rest
+            self.sock.close()
+            self.sock = None
+            if not self.reused:
+                break
+            # The pooled connection went stale, retry on another one
+        else:
+            return None, b""
+        self.bad_gateway()
+        return None, b""
+
+    def read_head(self):
+        try:
+            return read_response_head(self.sock)
+        except OSError:
+            return None, b""
+
+    def bad_gateway(self):
+        self.upstream.healthy = False
+        self.finish()
+        self.connection.sendall(httpserver.response(502, 'Bad Gateway', {"error": "Worker closed the connection"}))
+
+    def respond(self, head, rest):
+        # Relays a response with a length, returns whether the client connection can carry another request
+        length = content_length(head)
+        body = rest
+        while len(body) < length:
+            data = self.sock.recv(LB_BUFFER_SIZE)
+            if not data:
+                break
+            body += data
+        self.connection.sendall(head + body)
+        self.upstream.record_latency(time.monotonic() - self.started)
+
+        if len(body) == length and b"\r\nconnection: keep-alive" in head.lower():
+            self.upstream.release(self.sock)
+        else:
+            self.sock.close()
+        self.sock = None
+        self.finish()
+        return self.keep_alive
+
+    def start_stream(self, head, rest):
+        # Event streams have no length, bytes are relayed as they come until either side closes
+        self.connection.sendall(head + rest)
+        self.streaming = True
+        self.park((self.connection, self.sock), None)
+
+    def pump(self):
+        for source, target in ((self.sock, self.connection), (self.connection, self.sock)):
+            data = read_available(source, LB_BUFFER_SIZE)
+            if data == b"":
+                self.close()
+                return
+            if data:
+                target.sendall(data)
+        self.park((self.connection, self.sock), None)
+
+    def park(self, watching, seconds):
+        self.watching = watching
+        self.deadline = None if seconds is None else time.monotonic() + seconds
+        self.lb.waiter.park(self)
+
+    def overloaded(self, connection, reason):
+        # Pool shed callback, the waiter gave the connection back but no thread took it in time
+        if self.streaming:
+            metrics.shed.inc("lb", reason)
+        else:
+            shed(connection, "lb", reason)
+        self.close()
+
+    def finish(self):
+        # The exchange with the worker is over, however it went
+        if self.upstream is not None:
+            with self.lb.lock:
+                self.upstream.active -= 1
+            self.upstream = None
+
+    def close(self):
+        self.finish()
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        metrics.active_connections.dec("lb")
+        self.connection.close()
+
+
+class LBServer(threading.Thread):
+    def __init__(self, ip='0.0.0.0', port=8181, worker_ports=[56000, 56001, 56002, 56003], backlog=128,
+                 threads=512, queue_depth=256):
+        self.ip = ip
+        self.port = port
+        self.backlog = backlog
+        self.threads = threads
+        self.queue_depth = queue_depth
+        self.worker_ports = worker_ports
+        self.upstreams = []
+        self.ring = HashRing()
+        self.lock = threading.Lock()
+        for worker_port in worker_ports:
+            self.add_worker(worker_port)
+        threading.Thread.__init__(self)
+
+    def add_worker(self, worker_port):
+        with self.lock:
+            upstream = Upstream('localhost', worker_port)
+            self.upstreams.append(upstream)
+            self.ring.add(upstream, f"localhost:{worker_port}")
+
+    def run(self):
+        logging.warning(f"Load Balancer running on {self.ip}:{self.port}")
+        threading.Thread(target=self.health_check_loop, daemon=True).start()
+        lb_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        lb_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        lb_socket.bind((self.ip, self.port))
+        lb_socket.listen(self.backlog)
+        # Thread dari pool yang ukurannya tetap, hanya selama ada request yang diteruskan
+        self.pool = ConnectionPool("lb", self.handle_client, lambda conn, reason: shed(conn, "lb", reason),
+                                   self.threads, self.queue_depth)
+        self.waiter = Waiter(self.pool)
+        self.waiter.start()
+        while True:
+            try:
+                conn, addr = lb_socket.accept()
+            except OSError as e:
+                logging.error(f"Load Balancer accept failed: {e}")
+                time.sleep(0.1)
+                continue
+            logging.info("Load Balancer connection from %s", addr, extra={"sampled": True})
+            if not self.pool.submit(conn, addr):
+                shed(conn, "lb", "queue_full")
+
+    def health_check_loop(self):
+        while True:
+            for upstream in list(self.upstreams):
+                upstream.check_health()
+            time.sleep(HEALTH_CHECK_INTERVAL)
+
+    def choose_upstream(self, room_id=None):
+        with self.lock:
+            upstream = None
+            if room_id is not None:
+                # Sticky: the room's owner on the ring, skipping workers that are down
+                upstream = self.ring.get(room_id, lambda u: u.healthy)
+            if upstream is None:
+                # Least connections among healthy workers, the faster one wins a tie
+                candidates = [u for u in self.upstreams if u.healthy] or self.upstreams
+                upstream = min(candidates, key=lambda u: (u.active, u.latency))
+            upstream.active += 1
+        metrics.upstream_selected.inc(str(upstream.address[1]))
+        return upstream
+
+    def handle_client(self, conn, addr):
+        RelayClient(self, conn, addr).run()
+
+
+LB_PORT = 8181
+WORKER_BASE_PORT = 56000
+
+
+def create_worker(args, port):
+    # With --reuse-port every worker accepts public traffic itself
+    ipaddr = '0.0.0.0' if args.reuse_port else '127.0.0.1'
+    if args.mode == 'async':
+        return AsyncServer(ipaddr=ipaddr, port=port, backlog=args.backlog, max_connections=args.max_connections,
+                           queue_depth=args.queue_depth, reuse_port=args.reuse_port)
+    return Server(ipaddr=ipaddr, port=port, backlog=args.backlog, reuse_port=args.reuse_port,
+                  threads=args.threads, queue_depth=args.queue_depth)
+
+
+def run_worker_process(args, port):
+    # terminate() from the master should just end the worker
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if args.profile_interval:
+        metrics.start_profiler(args.profile_interval)
+    create_worker(args, port).run()
+
+
+def start_worker(args, port):
+    if args.processes:
+        worker = multiprocessing.Process(target=run_worker_process, args=(args, port), daemon=True)
+    else:
+        worker = create_worker(args, port)
+        # Blocked in accept() forever, must not keep the process alive after main() returns
+        worker.daemon = True
+    worker.start()
+    return worker
+
+
+def stop_worker(worker):
+    if isinstance(worker, multiprocessing.Process):
+        worker.terminate()
+    worker.join(1)  # Give each worker 1 second to join
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Liar's Deck HTTP server")
+    parser.add_argument('--mode', choices=['thread', 'async'], default='thread',
+                        help="thread: one thread per connection, async: asyncio event loop per worker")
+    parser.add_argument('--backlog', type=int, default=128, help="listen() backlog for workers and the load balancer")
+    parser.add_argument('--max-connections', type=int, default=1000,
+                        help="concurrent connections per async worker")
+    parser.add_argument('--threads', type=int, default=128,
+                        help="client threads per thread worker, the load balancer gets this times --workers")
+    parser.add_argument('--queue-depth', type=int, default=256,
+                        help="connections allowed to wait for a thread or slot, the rest get 503 with Retry-After")
+    parser.add_argument('--workers', type=int, default=4, help="number of workers")
+    parser.add_argument('--processes', action='store_true',
+                        help="run each worker in its own process instead of a thread of this one")
+    parser.add_argument('--reuse-port', action='store_true',
+                        help=f"workers share port {LB_PORT} via SO_REUSEPORT and LBServer is not started")
+    parser.add_argument('--reset-database', action='store_true',
+                        help="delete every stored game before the workers start")
+    parser.add_argument('--log-level', help="DEBUG, INFO, WARNING (default) or ERROR, overrides LOG_LEVEL")
+    parser.add_argument('--log-format', choices=['json', 'text'], help="overrides LOG_FORMAT, json by default")
+    parser.add_argument('--log-sample-rate', type=float,
+                        help="share of per-connection INFO records kept, overrides LOG_SAMPLE_RATE (0.01)")
+    parser.add_argument('--profile-interval', type=float, default=0,
+                        help="sample every thread's stack this often (seconds) for /metrics/profile, 0 disables it")
+    args = parser.parse_args()
+    if args.processes and args.workers > 1 and storage_backend() == 'memory':
+        # Each process would keep its own copy of every game, players spread over them would not meet
+        parser.error("--processes needs a shared storage backend, set GAME_STORAGE_BACKEND to sqlite or mongo")
+    return args
+
+
+def shutdown(signum, frame):
+    raise KeyboardInterrupt
 
 
 def main():
-    servers = []
+    args = parse_args()
+    configure_logging(args.log_level, args.log_format, args.log_sample_rate)
+    # Stopping the master (kill, systemd, docker stop) must take the worker processes with it
+    signal.signal(signal.SIGTERM, shutdown)
+    if args.reuse_port:
+        worker_ports = [LB_PORT] * args.workers
+    else:
+        worker_ports = [WORKER_BASE_PORT + i for i in range(args.workers)]
+    kind = f"{args.mode} {'process' if args.processes else 'thread'}"
+    if args.profile_interval:
+        metrics.start_profiler(args.profile_interval)
+
+    if args.reset_database:
+        create_store().reset_database()
+        logging.warning("Database reset")
+
+    workers = {}
+    lb = None
     try:
         # Start worker servers
-        for port in [56000, 56001, 56002, 56003]:
-            worker = Server(ipaddr='127.0.0.1', port=port)
-            worker.start()
-            servers.append(worker)
-            logging.warning(f"Worker started on port {port}")
+        for slot, port in enumerate(worker_ports):
+            workers[slot] = start_worker(args, port)
+            logging.warning(f"Worker ({kind}) started on port {port}")
 
         # Start load balancer
-        lb = LBServer(worker_ports=[56000, 56001, 56002, 56003])
-        lb.start()
-        servers.append(lb)
-        logging.warning("Load balancer started")
-
+        if not args.reuse_port:
+            # The balancer holds one thread for every connection it relays to any worker
+            lb = LBServer(port=LB_PORT, worker_ports=worker_ports, backlog=args.backlog,
+                          threads=args.threads * args.workers, queue_depth=args.queue_depth)
+            lb.daemon = True
+            lb.start()
+            logging.warning("Load balancer started")
+
+        # Supervise: a worker that dies is replaced on the same port
         while True:
-            for server in servers:
-                if not server.is_alive():
-                    logging.warning(f"Server thread died, exiting")
-                    return
+            for slot, worker in list(workers.items()):
+                if not worker.is_alive():
+                    logging.warning(f"Worker on port {worker_ports[slot]} died, restarting")
+                    workers[slot] = start_worker(args, worker_ports[slot])
+            if lb is not None and not lb.is_alive():
+                logging.warning("Load balancer thread died, exiting")
+                return
             threading.Event().wait(1)
 
     except KeyboardInterrupt:
@@ -168,10 +858,10 @@ def main():
     except Exception as e:
         logging.error(f"Error in main: {e}")
     finally:
-        logging.warning("Waiting for all threads to complete...")
-        for server in servers:
-            if server.is_alive():
-                server.join(1)  # Give each thread 1 second to join
+        logging.warning("Waiting for all workers to complete...")
+        for worker in workers.values():
+            if worker.is_alive():
+                stop_worker(worker)
         logging.warning("Server shutdown complete")
     exit(0)
 
@@ -0,0 +1,430 @@
+"""Self-play: bots play Liar's Deck offline to check rule balance and profile the rules.
+
+    python simulator.py --games 1000000 --players 4 --policies honest,random
+
+The python engine plays every game through rules.LiarDeckRules, the code
+the server runs, one move at a time. The numpy engine (used by default
+when NumPy is installed) plays the same rules for a whole batch of games
+per step on arrays, which is what makes millions of games practical.
+Both report games/sec, win rates by seat, roulette deaths and game length.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from collections import Counter
+from rules import LiarDeckRules, RANKS, RANK_INDEX, CARDS_PER_RANK, expand_cards
+
+try:
+    import numpy as np
+except ImportError:
+    # The python engine needs nothing beyond the rules
+    np = None
+
+DECK_SIZE = len(RANKS) * CARDS_PER_RANK
+# Most cards a bot puts on the pile in one play
+MAX_PLAY = 3
+# Games still going after this many moves are counted as stalled
+MAX_MOVES = 1000
+# Winner of a game where everybody is eliminated, next_turn calls it "No one"
+NO_ONE = -2
+
+
+class Policy:
+    """How a seat plays. choose() serves the python engine, choose_batch() the numpy one."""
+
+    name = None
+
+    def __init__(self, challenge_rate=0.3):
+        self.challenge_rate = challenge_rate
+
+    def choose(self, rules, player_id, rng):
+        """Card names to play, or None to challenge the last play."""
+        raise NotImplementedError
+
+    def choose_batch(self, turn, rng):
+        """For every game in turn (a BatchTurn): challenge flags and rank counts to play."""
+        raise NotImplementedError
+
+
+class RandomPolicy(Policy):
+    """Challenges at challenge_rate, otherwise plays 1 to MAX_PLAY random cards from its hand."""
+
+    name = "random"
+
+    def choose(self, rules, player_id, rng):
+        if rules.last_play["player_id"] and rng.random() < self.challenge_rate:
+            return None
+        hand = expand_cards(rules.players[player_id]["hand"])
+        return rng.sample(hand, rng.randint(1, min(MAX_PLAY, len(hand))))
+
+    def choose_batch(self, turn, rng):
+        challenge = turn.has_last & (rng.random(len(turn.ref)) < self.challenge_rate)
+        total = turn.hand.sum(1)
+        count = rng.integers(1, np.maximum(np.minimum(total, MAX_PLAY), 1) + 1) * (total > 0)
+        return challenge, sample_cards(turn.hand, count, rng)
+
+
+class HonestPolicy(Policy):
+    """Plays its reference cards when it has some and bluffs a single card when it has none.
+
+    Challenges a claim that cannot be true given its own hand, and any
+    other claim at challenge_rate.
+    """
+
+    name = "honest"
+
+    def choose(self, rules, player_id, rng):
+        hand = rules.players[player_id]["hand"]
+        held = hand[RANK_INDEX[rules.reference_card]]
+        if rules.last_play["player_id"]:
+            impossible = len(rules.last_play["cards"]) + held > CARDS_PER_RANK
+            if impossible or rng.random() < self.challenge_rate:
+                return None
+        if held:
+            return [rules.reference_card] * min(held, MAX_PLAY)
+        return [rng.choice(expand_cards(hand))]
+
+    def choose_batch(self, turn, rng):
+        rows = np.arange(len(turn.ref))
+        held = turn.hand[rows, turn.ref]
+        impossible = turn.last_count + held > CARDS_PER_RANK
+        challenge = turn.has_last & (impossible | (rng.random(len(rows)) < self.challenge_rate))
+        played = sample_cards(turn.hand, (held == 0).astype(int), rng)
+        played[rows, turn.ref] += np.minimum(held, MAX_PLAY)
+        return challenge, played
+
+
+POLICIES = {policy.name: policy for policy in (RandomPolicy, HonestPolicy)}
+
+
+def sample_cards(hand, count, rng):
+    """Rank counts of count[i] cards drawn without replacement from hand[i] (rank counts)."""
+    remaining = hand.copy()
+    drawn = np.zeros_like(hand)
+    rows = np.arange(len(hand))
+    for i in range(MAX_PLAY):
+        total = remaining.sum(1)
+        draw = (count > i) & (total > 0)
+        if not draw.any():
+            break
+        # Card number pick among those left, then the rank it falls in
+        pick = (rng.random(len(hand)) * total).astype(int)
+        rank = np.minimum((remaining.cumsum(1) <= pick[:, None]).sum(1), len(RANKS) - 1)
+        drawn[rows[draw], rank[draw]] += 1
+        remaining[rows[draw], rank[draw]] -= 1
+    return drawn
+
+
+class Stats:
+    def __init__(self, players):
+        self.games = 0
+        self.wins = [0] * players
+        self.wins_by = Counter()
+        self.stalled = 0
+        self.deaths_by_pull = Counter()
+        self.moves = 0
+        self.max_moves = 0
+        self.challenges = 0
+        self.deals = 0
+
+    def report(self, elapsed):
+        games = self.games or 1
+        return {
+            "games": self.games,
+            "elapsed": round(elapsed, 3),
+            "games_per_sec": round(self.games / elapsed, 1) if elapsed else 0.0,
+            "win_rate_by_seat": {f"player{seat + 1}": round(wins / games, 4) for seat, wins in enumerate(self.wins)},
+            "wins_by": dict(self.wins_by),
+            "stalled": self.stalled,
+            # Trigger pull (1 to 3) that killed each eliminated player
+            "roulette_deaths_by_pull": {str(pull): count for pull, count in sorted(self.deaths_by_pull.items())},
+            "deaths_per_game": round(sum(self.deaths_by_pull.values()) / games, 3),
+            "moves_per_game": round(self.moves / games, 2),
+            "max_moves": self.max_moves,
+            "challenges_per_game": round(self.challenges / games, 2),
+            "deals_per_game": round(self.deals / games, 2),
+        }
+
+
+class SimulatedGame(LiarDeckRules):
+    def __init__(self, rng):
+        super().__init__(rng)
+        self.deals = 0
+
+    def add_to_log(self, message):
+        # Nobody reads the log of a simulated game
+        self.log_count += 1
+
+    def generate_new_deck(self):
+        self.deals += 1
+        super().generate_new_deck()
+
+
+def play_python(games, policies, seed, stats):
+    rng = random.Random(seed)
+    player_ids = [f"player{seat + 1}" for seat in range(len(policies))]
+    for _ in range(games):
+        game = SimulatedGame(rng)
+        game.start_round(player_ids)
+        moves = challenges = 0
+        while game.game_winner is None and moves < MAX_MOVES:
+            player_id = game.player_order[game.current_turn_index]
+            cards = policies[game.current_turn_index].choose(game, player_id, rng)
+            if cards is None:
+                loser = game.resolve_challenge(player_id)["challenge_loser"]
+                if game.players[loser]["is_eliminated"]:
+                    stats.deaths_by_pull[game.players[loser]["roulette_index"] + 1] += 1
+                challenges += 1
+            else:
+                game.play_cards(player_id, cards)
+            moves += 1
+
+        stats.games += 1
+        stats.moves += moves
+        stats.max_moves = max(stats.max_moves, moves)
+        stats.challenges += challenges
+        stats.deals += game.deals + 1
+        if game.game_winner in game.players:
+            stats.wins[player_ids.index(game.game_winner)] += 1
+            empty = sum(game.players[game.game_winner]["hand"]) == 0
+            stats.wins_by["empty_hand" if empty else "last_standing"] += 1
+        else:
+            stats.stalled += 1
+
+
+class BatchTurn:
+    """What the player to move sees in each game of a batch."""
+
+    def __init__(self, hand, ref, has_last, last_count):
+        self.hand = hand
+        self.ref = ref
+        self.has_last = has_last
+        self.last_count = last_count
+
+
+class BatchTable:
+    """n games of the same size as arrays, following LiarDeckRules move for move.
+
+    The card pile is not kept, no rule reads it; the last play is kept as
+    its size and whether it was a lie.
+    """
+
+    FIELDS = ("hands", "bullet", "pulls", "eliminated", "turn", "ref", "last_player", "last_count", "last_lie",
+              "winner", "moves", "challenges", "deals")
+
+    def __init__(self, games, players, rng):
+        self.rng = rng
+        self.hands = np.zeros((games, players, len(RANKS)), dtype=np.int16)
+        self.bullet = rng.integers(0, 3, (games, players))
+        self.pulls = np.zeros((games, players), dtype=np.int64)
+        self.eliminated = np.zeros((games, players), dtype=bool)
+        self.turn = np.zeros(games, dtype=np.int64)
+        self.ref = np.zeros(games, dtype=np.int64)
+        self.last_player = np.full(games, -1)
+        self.last_count = np.zeros(games, dtype=np.int64)
+        self.last_lie = np.zeros(games, dtype=bool)
+        self.winner = np.full(games, -1)
+        self.moves = np.zeros(games, dtype=np.int64)
+        self.challenges = np.zeros(games, dtype=np.int64)
+        self.deals = np.zeros(games, dtype=np.int64)
+        self.deal(np.arange(games))
+
+    def keep(self, mask):
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field)[mask])
+
+    def deal(self, games):
+        """generate_new_deck for the given games: a new reference card and fresh hands for the living."""
+        if not len(games):
+            return
+        count, players = len(games), self.hands.shape[1]
+        # Rank of the card at each deck position, after a shuffle
+        deck = self.rng.permuted(np.tile(np.arange(DECK_SIZE) // CARDS_PER_RANK, (count, 1)), axis=1)
+        self.ref[games] = self.rng.integers(0, len(RANKS), count)
+        self.deals[games] += 1
+
+        active = ~self.eliminated[games]
+        living = active.sum(1)
+        per_player = DECK_SIZE // np.maximum(living, 1)
+        # Living players take consecutive slices of the deck in seat order
+        slot = np.cumsum(active, 1) - 1
+        seat_of_slot = np.zeros((count, players), dtype=np.int64)
+        alive_rows, alive_seats = np.nonzero(active)
+        seat_of_slot[alive_rows, slot[alive_rows, alive_seats]] = alive_seats
+        position_slot = np.arange(DECK_SIZE)[None, :] // per_player[:, None]
+        dealt_rows, positions = np.nonzero(position_slot < living[:, None])
+        owner = seat_of_slot[dealt_rows, position_slot[dealt_rows, positions]]
+
+        # Cards per (game, seat, rank), counted in one pass; the dead keep whatever they held
+        cell = (dealt_rows * players + owner) * len(RANKS) + deck[dealt_rows, positions]
+        dealt = np.bincount(cell, minlength=count * players * len(RANKS)).reshape(count, players, len(RANKS))
+        self.hands[games] = np.where(active[:, :, None], dealt, self.hands[games])
+
+    def step(self, policies, stats):
+        """Every game in the batch makes one move."""
+        rows = np.arange(len(self.turn))
+        challenge = np.zeros(len(rows), dtype=bool)
+        played = np.zeros((len(rows), len(RANKS)), dtype=self.hands.dtype)
+        # Each distinct policy decides for all the games where one of its seats is to move
+        for policy in dict.fromkeys(policies):
+            seats = [seat for seat, seat_policy in enumerate(policies) if seat_policy is policy]
+            games = np.flatnonzero(np.isin(self.turn, seats))
+            if not len(games):
+                continue
+            turn = BatchTurn(self.hands[games, self.turn[games]], self.ref[games], self.last_player[games] >= 0,
+                             self.last_count[games])
+            challenge[games], played[games] = policy.choose_batch(turn, self.rng)
+
+        challenge &= self.last_player >= 0
+        self.moves += 1
+        self.challenge(np.flatnonzero(challenge), stats)
+        self.play(np.flatnonzero(~challenge), played)
+
+    def play(self, games, played):
+        # Someone who emptied their hand last turn and was not challenged wins instead
+        empty = (self.hands[games].sum(2) == 0) & ~self.eliminated[games]
+        finished = empty.any(1)
+        self.winner[games[finished]] = empty[finished].argmax(1)
+        games = games[~finished]
+
+        seat = self.turn[games]
+        cards = played[games]
+        self.hands[games, seat] -= cards
+        self.last_player[games] = seat
+        self.last_count[games] = cards.sum(1)
+        self.last_lie[games] = cards[np.arange(len(games)), self.ref[games]] != self.last_count[games]
+        self.next_turn(games)
+
+    def next_turn(self, games):
+        active = ~self.eliminated[games]
+        living = active.sum(1)
+        over = living <= 1
+        self.winner[games[over]] = np.where(living[over] == 1, active[over].argmax(1), NO_ONE)
+        games, active = games[~over], active[~over]
+
+        all_empty = ((self.hands[games].sum(2) == 0) | ~active).all(1)
+        self.deal(games[all_empty])
+
+        # Next living seat after the current one
+        players = active.shape[1]
+        seats = (self.turn[games, None] + 1 + np.arange(players)[None, :]) % players
+        rows = np.arange(len(games))
+        following = seats[rows, active[rows[:, None], seats].argmax(1)]
+        self.turn[games] = following
+
+        no_cards = self.hands[games, following].sum(1) == 0
+        self.winner[games[no_cards]] = following[no_cards]
+
+    def challenge(self, games, stats):
+        challenger = self.turn[games]
+        lie = self.last_lie[games]
+        loser = np.where(lie, self.last_player[games], challenger)
+        winner = np.where(lie, challenger, self.last_player[games])
+        self.challenges[games] += 1
+
+        # proceed_roulette: the bullet sits in chamber "bullet", pulls counts the empty ones so far
+        dead = self.pulls[games, loser] == self.bullet[games, loser]
+        for pull, count in enumerate(np.bincount(self.pulls[games[dead], loser[dead]] + 1)):
+            if count:
+                stats.deaths_by_pull[pull] += int(count)
+        self.eliminated[games[dead], loser[dead]] = True
+        self.pulls[games[~dead], loser[~dead]] += 1
+
+        self.last_player[games] = -1
+        self.deal(games)
+
+        active = ~self.eliminated[games]
+        over = active.sum(1) <= 1
+        self.winner[games[over]] = np.where(active[over].any(1), active[over].argmax(1), NO_ONE)
+        self.turn[games[~over]] = winner[~over]
+
+    def record(self, mask, stats):
+        winners = self.winner[mask]
+        won = winners >= 0
+        players = self.hands.shape[1]
+        stats.games += int(mask.sum())
+        stats.stalled += int((~won).sum())
+        for seat, wins in enumerate(np.bincount(winners[won], minlength=players)):
+            stats.wins[seat] += int(wins)
+        games = np.flatnonzero(mask)[won]
+        empty = self.hands[games, winners[won]].sum(1) == 0
+        stats.wins_by["empty_hand"] += int(empty.sum())
+        stats.wins_by["last_standing"] += int((~empty).sum())
+        stats.moves += int(self.moves[mask].sum())
+        stats.max_moves = max(stats.max_moves, int(self.moves[mask].max()))
+        stats.challenges += int(self.challenges[mask].sum())
+        stats.deals += int(self.deals[mask].sum())
+
+
+def play_numpy(games, policies, seed, stats, batch_size):
+    rng = np.random.default_rng(seed)
+    while games > 0:
+        table = BatchTable(min(batch_size, games), len(policies), rng)
+        games -= len(table.turn)
+        while len(table.turn):
+            table.step(policies, stats)
+            done = (table.winner != -1) | (table.moves >= MAX_MOVES)
+            if done.any():
+                # Finished games leave the arrays, later steps only touch the ones still going
+                table.record(done, stats)
+                table.keep(~done)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Liar's Deck self-play simulator")
+    parser.add_argument('--games', type=int, default=10000)
+    parser.add_argument('--players', type=int, choices=[2, 3, 4], default=4)
+    parser.add_argument('--policies', default='random',
+                        help=f"policy per seat, comma separated ({', '.join(POLICIES)}); one name fills every seat")
+    parser.add_argument('--challenge-rate', type=float, default=0.3)
+    parser.add_argument('--engine', choices=['auto', 'numpy', 'python'], default='auto',
+                        help="auto: numpy when it is installed")
+    parser.add_argument('--batch-size', type=int, default=100000, help="games per numpy batch")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--output', help="write the JSON results here instead of stdout")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    names = args.policies.split(',')
+    if len(names) == 1:
+        names = names * args.players
+    if len(names) != args.players or any(name not in POLICIES for name in names):
+        sys.exit(f"--policies needs {args.players} names out of: {', '.join(POLICIES)}")
+    instances = {name: POLICIES[name](args.challenge_rate) for name in set(names)}
+    policies = [instances[name] for name in names]
+
+    engine = args.engine
+    if engine == 'auto':
+        engine = 'python' if np is None else 'numpy'
+    if engine == 'numpy' and np is None:
+        sys.exit("The numpy engine needs NumPy installed, or use --engine python")
+
+    stats = Stats(args.players)
+    started = time.perf_counter()
+    if engine == 'numpy':
+        play_numpy(args.games, policies, args.seed, stats, args.batch_size)
+    else:
+        play_python(args.games, policies, args.seed, stats)
+    elapsed = time.perf_counter() - started
+
+    results = {
+        "config": {"engine": engine, "players": args.players, "policies": names,
+                   "challenge_rate": args.challenge_rate, "seed": args.seed},
+        **stats.report(elapsed),
+    }
+    print(f"{engine}: {results['games']} games in {results['elapsed']}s, {results['games_per_sec']} games/s",
+          file=sys.stderr)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
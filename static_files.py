@@ -0,0 +1,84 @@
+import gzip
+import hashlib
+import os
+import stat
+from email.utils import formatdate, parsedate_to_datetime
+
+# Smaller files are not worth the Content-Encoding header
+MIN_GZIP_SIZE = 512
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json')
+
+
+class StaticAsset:
+    def __init__(self, content, content_type, mtime_ns):
+        self.content = content
+        self.content_type = content_type
+        self.mtime_ns = mtime_ns
+        self.size = len(content)
+        # Content hash, so every worker process hands out the same ETag
+        self.etag = '"' + hashlib.sha1(content).hexdigest()[:16] + '"'
+        self.mtime = mtime_ns // 1_000_000_000
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+
+        self.gzipped = None
+        if self.size >= MIN_GZIP_SIZE and content_type.startswith(COMPRESSIBLE_TYPES):
+            compressed = gzip.compress(content, compresslevel=9, mtime=0)
+            if len(compressed) < self.size:
+                self.gzipped = compressed
+
+    def not_modified(self, request_headers):
+        if_none_match = request_headers.get('if-none-match')
+        if if_none_match is not None:
+            # If-None-Match wins over If-Modified-Since when both are sent
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or self.etag in tags or 'W/' + self.etag in tags
+
+        if_modified_since = request_headers.get('if-modified-since')
+        if if_modified_since is not None:
+            try:
+                return parsedate_to_datetime(if_modified_since).timestamp() >= self.mtime
+            except (TypeError, ValueError):
+                return False
+        return False
+
+
+class StaticFiles:
+    """Files under www/, kept in memory and re-read when their mtime or size changes."""
+
+    def __init__(self, root, types):
+        self.root = os.path.realpath(root)
+        self.types = types
+        self.cache = {}
+
+    def resolve(self, path):
+        """Map a decoded request path to a file inside root, or None when it points outside."""
+        relative = path.lstrip('/')
+        if '\x00' in relative:
+            return None
+        filepath = os.path.realpath(os.path.join(self.root, relative))
+        if os.path.commonpath([self.root, filepath]) != self.root:
+            return None
+        return filepath
+
+    def get(self, filepath):
+        """Cached asset for a resolved path, or None when there is no such file."""
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        asset = self.cache.get(filepath)
+        if asset is not None and asset.mtime_ns == st.st_mtime_ns and asset.size == st.st_size:
+            return asset
+
+        try:
+            with open(filepath, 'rb') as f:
+                content = f.read()
+        except OSError:
+            return None
+        content_type = self.types.get(os.path.splitext(filepath)[1], 'application/octet-stream')
+        asset = StaticAsset(content, content_type, st.st_mtime_ns)
+        self.cache[filepath] = asset
+        return asset
@@ -0,0 +1,225 @@
+import copy
+import json
+import os
+import sqlite3
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Log entries kept inline with the stored game, older ones only live in the log history
+LOG_TAIL = 20
+
+
+class VersionConflict(Exception):
+    pass
+
+
+class StorageUnavailable(Exception):
+    pass
+
+
+class GameStore:
+    """What LiarDeckGame needs from storage, one instance per room.
+
+    A game is a single document (see LiarDeckGame.to_document) plus an
+    append-only log history. save_game receives only the fields a move
+    changed, with new log lines under "log_entries", and must apply them
+    all or nothing when the stored version still equals expected_version.
+    """
+
+    def load_game(self):
+        """The stored document with its "version", or None for a new room."""
+        raise NotImplementedError
+
+    def get_version(self):
+        raise NotImplementedError
+
+    def save_game(self, changes, expected_version, move_id=None):
+        """Apply changes and return the new version, or raise VersionConflict.
+
+        Saving again with the move_id of the write that produced the
+        current version is a no-op that returns that version.
+        """
+        raise NotImplementedError
+
+    def get_log_page(self, after, limit):
+        """Up to limit {"seq", "message"} entries with seq > after, oldest first."""
+        raise NotImplementedError
+
+    def reset_database(self):
+        raise NotImplementedError
+
+    def ping(self):
+        """Raise StorageUnavailable when the backend cannot serve requests."""
+
+
+def merge_changes(doc, changes, version, move_id):
+    # Same rules as the Mongo document layout: fields are replaced, log lines appended
+    doc = dict(doc or {})
+    fields = copy.deepcopy(changes)
+    log_entries = fields.pop("log_entries", None)
+    doc.update(fields)
+    if log_entries and "log" not in fields:
+        doc["log"] = ((doc.get("log") or []) + log_entries)[-LOG_TAIL:]
+    doc["version"] = version
+    doc["move_id"] = move_id
+    return doc
+
+
+def first_log_seq(changes):
+    return changes["log_count"] - len(changes["log_entries"]) + 1
+
+
+class MemoryStore(GameStore):
+    """Games live in this process only, for single-process deployments and benchmarks."""
+
+    lock = threading.Lock()
+    games = {}
+    logs = {}
+
+    def __init__(self, room_id="default"):
+        self.room_id = room_id
+
+    def load_game(self):
+        doc = self.games.get(self.room_id)
+        return copy.deepcopy(doc) if doc else None
+
+    def get_version(self):
+        doc = self.games.get(self.room_id)
+        return doc["version"] if doc else None
+
+    def save_game(self, changes, expected_version, move_id=None):
+        with self.lock:
+            doc = self.games.get(self.room_id)
+            current = doc["version"] if doc else 0
+            if move_id is not None and doc and doc.get("move_id") == move_id:
+                return current
+            if current != expected_version:
+                raise VersionConflict(f"expected version {expected_version}")
+
+            version = expected_version + 1
+            self.games[self.room_id] = merge_changes(doc, changes, version, move_id)
+            if changes.get("log_entries"):
+                history = self.logs.setdefault(self.room_id, {})
+                for seq, message in enumerate(changes["log_entries"], first_log_seq(changes)):
+                    history[seq] = message
+            return version
+
+    def get_log_page(self, after, limit):
+        history = self.logs.get(self.room_id, {})
+        return [{"seq": seq, "message": history[seq]} for seq in range(after + 1, after + 1 + limit) if seq in history]
+
+    def reset_database(self):
+        with self.lock:
+            self.games.clear()
+            self.logs.clear()
+
+
+class SQLiteStore(GameStore):
+    """Games in a local SQLite file (WAL mode), persistent without a database server.
+
+    Processes on the same machine can share the file. Writes take the
+    database lock with BEGIN IMMEDIATE, so the version check and the
+    update happen as one step.
+    """
+
+    local = threading.local()
+
+    def __init__(self, room_id="default", path=None):
+        self.room_id = room_id
+        self.path = path or os.getenv('GAME_SQLITE_PATH', 'liar_decks.db')
+
+    @property
+    def db(self):
+        # sqlite3 connections belong to one thread, and must not cross a fork
+        connections = getattr(self.local, 'connections', None)
+        if connections is None or self.local.pid != os.getpid():
+            connections = self.local.connections = {}
+            self.local.pid = os.getpid()
+        if self.path not in connections:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS games ("
+                "room_id TEXT PRIMARY KEY, version INTEGER NOT NULL, move_id TEXT, document TEXT NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS game_log ("
+                "room_id TEXT NOT NULL, seq INTEGER NOT NULL, message TEXT NOT NULL, PRIMARY KEY (room_id, seq))"
+            )
+            connections[self.path] = db
+        return connections[self.path]
+
+    def load_game(self):
+        row = self.db.execute("SELECT document FROM games WHERE room_id = ?", (self.room_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_version(self):
+        row = self.db.execute("SELECT version FROM games WHERE room_id = ?", (self.room_id,)).fetchone()
+        return row[0] if row else None
+
+    def save_game(self, changes, expected_version, move_id=None):
+        db = self.db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT version, move_id, document FROM games WHERE room_id = ?",
+                             (self.room_id,)).fetchone()
+            current = row[0] if row else 0
+            if move_id is not None and row and row[1] == move_id:
+                db.execute("ROLLBACK")
+                return current
+            if current != expected_version:
+                raise VersionConflict(f"expected version {expected_version}")
+
+            version = expected_version + 1
+            doc = merge_changes(json.loads(row[2]) if row else None, changes, version, move_id)
+            db.execute(
+                "INSERT OR REPLACE INTO games (room_id, version, move_id, document) VALUES (?, ?, ?, ?)",
+                (self.room_id, version, move_id, json.dumps(doc))
+            )
+            if changes.get("log_entries"):
+                db.executemany(
+                    "INSERT OR IGNORE INTO game_log (room_id, seq, message) VALUES (?, ?, ?)",
+                    [(self.room_id, seq, message)
+                     for seq, message in enumerate(changes["log_entries"], first_log_seq(changes))]
+                )
+            db.execute("COMMIT")
+            return version
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def get_log_page(self, after, limit):
+        rows = self.db.execute(
+            "SELECT seq, message FROM game_log WHERE room_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+            (self.room_id, after, limit)
+        ).fetchall()
+        return [{"seq": seq, "message": message} for seq, message in rows]
+
+    def reset_database(self):
+        self.db.execute("DELETE FROM games")
+        self.db.execute("DELETE FROM game_log")
+
+    def ping(self):
+        try:
+            self.db.execute("SELECT 1")
+        except sqlite3.Error as e:
+            raise StorageUnavailable(str(e))
+
+
+def storage_backend():
+    # GAME_STORAGE_BACKEND picks mongo (default), sqlite or memory
+    return os.getenv('GAME_STORAGE_BACKEND', 'mongo')
+
+
+def create_store(room_id="default"):
+    backend = storage_backend()
+    if backend == 'memory':
+        return MemoryStore(room_id)
+    if backend == 'sqlite':
+        return SQLiteStore(room_id)
+    # Imported here so the other backends run without pymongo installed
+    from mongo_client import create_client
+    return create_client(room_id)
@@ -3,8 +3,13 @@ document.addEventListener("DOMContentLoaded", () => {
 
   // Global variable to hold the player's ID
   let myPlayerId = null;
+  // Room the player sits in, taken from ?room=... (defaults to the shared table)
+  const myRoomId =
+    new URLSearchParams(window.location.search).get("room") || "default";
   let isPolling = false;
   let isLoading = false;
+  // Last full state shown, /game/state patches are applied on top of it
+  let gameState = null;
 
   const opponentsDiv = document.getElementById("opponents");
   const startButton = document.getElementById("start-game-button");
@@ -78,17 +83,20 @@ document.addEventListener("DOMContentLoaded", () => {
       myPlayerId = existingPlayerId;
       document.getElementById("player-id").textContent = myPlayerId;
       await getGameState(); // Initial fetch
-      pollGameState(); // Start polling
+      subscribeToGameState(); // Start listening for updates
     } else {
       try {
         const response = await fetch(`${API_URL}/game/join`, {
           method: "POST",
+          body: JSON.stringify({ room_id: myRoomId }),
         });
         const data = await response.json();
 
         if (response.ok && data.player_id) {
           myPlayerId = data.player_id;
-          const newUrl = `${window.location.pathname}?player=${myPlayerId}`;
+          const newUrl = `${window.location.pathname}?room=${encodeURIComponent(
+            myRoomId
+          )}&player=${myPlayerId}`;
           history.pushState({ path: newUrl }, "", newUrl);
 
           document.getElementById("player-id").textContent = myPlayerId;
@@ -96,7 +104,7 @@ document.addEventListener("DOMContentLoaded", () => {
           localStorage.setItem("auth_key", data.key || ""); // Store auth key if provided
 
           await getGameState(); // Initial fetch
-          pollGameState(); // Start polling
+          subscribeToGameState(); // Start listening for updates
         } else {
           alert("Failed to join game: " + (data.message || "Unknown error"));
           logUl.innerHTML = `<li><b>Error:</b> ${data.message}</li>`;
@@ -116,6 +124,7 @@ document.addEventListener("DOMContentLoaded", () => {
       console.log("Skipping UI update due to no state.");
       return;
     }
+    if (state.version !== undefined) gameState = state;
 
     opponentsDiv.innerHTML = "";
     logUl.innerHTML = "";
@@ -220,12 +229,23 @@ document.addEventListener("DOMContentLoaded", () => {
     }
   }
 
+  // Only changes since the version already shown, or the full state if the
+  // server cannot diff against it
+  function applyStatePatch(data) {
+    if (!data.changes) return data;
+    if (!gameState || gameState.version !== data.since) return null;
+    return { ...gameState, ...data.changes, version: data.version };
+  }
+
   async function getGameState() {
     if (!myPlayerId) return null;
     try {
       setLoading(true);
+      const since = gameState ? `&since=${gameState.version}` : "";
       const response = await fetch(
-        `${API_URL}/game/state?player_id=${myPlayerId}`,
+        `${API_URL}/game/state?room_id=${encodeURIComponent(
+          myRoomId
+        )}&player_id=${myPlayerId}${since}`,
         {
           headers: {
             "Content-Type": "application/json",
@@ -233,12 +253,21 @@ document.addEventListener("DOMContentLoaded", () => {
           },
         }
       );
+      if (response.status === 304) {
+        setLoading(false);
+        return gameState;
+      }
       if (!response.ok) {
         console.error("Failed to get game state, status:", response.status);
         return null;
       }
 
-      const state = await response.json();
+      const state = applyStatePatch(await response.json());
+      if (!state) {
+        // Patch against a version we no longer have, start over
+        gameState = null;
+        return getGameState();
+      }
 
       if (!localStorage.getItem("auth_key")) {
         const authKey = state.key;
@@ -255,20 +284,66 @@ document.addEventListener("DOMContentLoaded", () => {
     }
   }
 
-  async function pollGameState() {
+  function subscriptionQuery() {
+    return `room_id=${encodeURIComponent(myRoomId)}&player_id=${myPlayerId}`;
+  }
+
+  // The server pushes a new state whenever the game version changes.
+  // Without EventSource, or once the stream is refused, fall back to long-polling.
+  function subscribeToGameState() {
     if (isPolling) return;
     isPolling = true;
 
+    if (!window.EventSource) {
+      longPollGameState();
+      return;
+    }
+
+    const eventSource = new EventSource(
+      `${API_URL}/game/events?${subscriptionQuery()}`
+    );
+    eventSource.onmessage = (event) => updateUI(JSON.parse(event.data));
+    eventSource.onerror = () => {
+      // CONNECTING means the browser is already retrying on its own
+      if (eventSource.readyState === EventSource.CLOSED) {
+        longPollGameState();
+      }
+    };
+  }
+
+  async function longPollGameState() {
+    let version = -1;
+
     while (true) {
-      const state = await getGameState();
-      if (!state || state.game_winner || state.current_turn === myPlayerId) {
-        break;
+      try {
+        const response = await fetch(
+          `${API_URL}/game/subscribe?${subscriptionQuery()}&since=${version}`
+        );
+        if (response.status === 200) {
+          const state = await response.json();
+          if (typeof state.version === "number") {
+            version = state.version;
+            updateUI(state);
+          } else {
+            // An error or a patch, neither says which version to wait on: fetch the full state
+            const fullState = await getGameState();
+            if (fullState && typeof fullState.version === "number") {
+              version = fullState.version;
+            } else {
+              version = -1;
+              await new Promise((resolve) => setTimeout(resolve, 2000));
+            }
+          }
+        } else if (response.status !== 204) {
+          // Tunggu 2 detik sebelum mencoba lagi, atau selama Retry-After kalau server sibuk
+          const retryAfter = Number(response.headers.get("Retry-After")) || 2;
+          await new Promise((resolve) => setTimeout(resolve, retryAfter * 1000));
+        }
+      } catch (error) {
+        console.error("Error waiting for game state:", error);
+        await new Promise((resolve) => setTimeout(resolve, 2000));
       }
-      // Tunggu 2 detik sebelum polling lagi
-      await new Promise((resolve) => setTimeout(resolve, 2000));
     }
-
-    isPolling = false;
   }
 
   startButton.addEventListener("click", async () => {
@@ -276,7 +351,10 @@ document.addEventListener("DOMContentLoaded", () => {
       setLoading(true);
       const response = await fetch(`${API_URL}/game/start`, {
         method: "POST",
-        body: JSON.stringify({ key: localStorage.getItem("auth_key") }),
+        body: JSON.stringify({
+          room_id: myRoomId,
+          key: localStorage.getItem("auth_key"),
+        }),
       });
       const data = await response.json();
       if (!response.ok) {
@@ -284,7 +362,7 @@ document.addEventListener("DOMContentLoaded", () => {
         setLoading(false);
       }
       await getGameState();
-      await pollGameState(); // Mulai polling setelah game dimulai
+      subscribeToGameState();
     } catch (error) {
       console.error("Error starting game:", error);
       alert("Could not start the game.");
@@ -312,15 +390,15 @@ document.addEventListener("DOMContentLoaded", () => {
         method: "POST",
         headers: { "Content-Type": "application/json" },
         body: JSON.stringify({
+          room_id: myRoomId,
           player_id: myPlayerId,
           cards: cardsToPlay,
           key: playerKey,
         }),
       });
 
-      // Ambil state terbaru & mulai polling lagi karena giliran kita sudah selesai
+      // Ambil state terbaru, update berikutnya datang dari subscription
       await getGameState();
-      await pollGameState();
     } catch (error) {
       console.error("Error playing cards:", error);
       setLoading(false);
@@ -337,13 +415,13 @@ document.addEventListener("DOMContentLoaded", () => {
           method: "POST",
           headers: { "Content-Type": "application/json" },
           body: JSON.stringify({
+            room_id: myRoomId,
             player_id: myPlayerId,
             key: localStorage.getItem("auth_key"),
           }),
         });
-        // Ambil state terbaru & mulai polling lagi karena giliran kita sudah selesai
+        // Ambil state terbaru, update berikutnya datang dari subscription
         await getGameState();
-        await pollGameState();
       } catch (error) {
         console.error("Error challenging:", error);
         setLoading(false);